@@ -1,3 +1,7 @@
+import argparse
+import os
+import sqlite3
+import threading
 import pygame
 import pygame.draw
 import random
@@ -6,6 +10,13 @@ import numpy as np
 FPS = 30
 W_WIDTH, W_HEIGHT = 800, 600
 dt = 0.01
+# The game made one step of length dt per frame at FPS frames per second; it keeps that speed at any frame rate.
+STEPS_PER_SECOND = 30
+MAX_STEPS_PER_FRAME = 5
+MAX_SKIPPED_FRAMES = 3
+# A click in a bigger swarm is resolved by scanning all the targets, because rebuilding the grid takes longer.
+MAX_GRID_TARGETS = 20000
+ASSET_DIR = os.path.dirname(os.path.abspath(__file__))
 
 RED = (255, 0, 0)
 BLUE = (0, 0, 255)
@@ -15,10 +26,60 @@ MAGENTA = (255, 0, 255)
 CYAN = (0, 255, 255)
 BLACK = (0, 0, 0)
 COLORS = [RED, BLUE, YELLOW, GREEN, MAGENTA, CYAN]
+BALL, SQUARE = 0, 1
+
+
+class AssetCache:
+    def __init__(self, directory=ASSET_DIR):
+        """ Creates a cache of images. Each image file is decoded once, converted to the format of the display once
+        and shared by all the objects, which use it.
+
+        :param directory: directory the names of the images are relative to.
+        """
+        self.directory = directory
+        self.decoded = {}
+        self.images = {}
+        self.thread = None
+
+    def load(self, name):
+        """ Decodes the image file, unless it has been decoded already.
+
+        :param name: name of the image file.
+        :return: surface with the image in the format of the file.
+        """
+        if name not in self.decoded:
+            self.decoded[name] = pygame.image.load(os.path.join(self.directory, name))
+        return self.decoded[name]
+
+    def preload(self, names):
+        """ Starts decoding the image files on a background thread, so that they are ready before the first frame.
+
+        :param names: names of the image files.
+        """
+        self.thread = threading.Thread(target=lambda: [self.load(name) for name in names], daemon=True)
+        self.thread.start()
+
+    def get(self, name):
+        """ Returns the image converted to the format of the display, with per-pixel alpha.
+
+        :param name: name of the image file.
+        """
+        if name not in self.images:
+            if self.thread is not None:
+                self.thread.join()
+                self.thread = None
+            image = self.load(name)
+            if pygame.display.get_surface() is not None:
+                image = image.convert_alpha()
+            self.images[name] = image
+        return self.images[name]
+
+
+assets = AssetCache()
 
 
 class Square:
-    def __init__(self, screen, player_points):
+    def __init__(self, player_points):
         """ Creates a square object based on how good the player is playing.
 
         points - number of points given to the player if the square is hit.
@@ -26,9 +87,7 @@ class Square:
         a - length of the side of the square.
         vx, vy - velocity of the square.
         color - color of the square.
-        image - image of the square.
 
-        :param screen: screen, on which the square is drawn.
         :param player_points: number of points the player scored in the game.
         """
         self.points = random.randint(50, 100) + int((player_points / 2) ** 0.5)
@@ -42,10 +101,6 @@ class Square:
         self.vy = random.randint(0, 100 + int(self.points**0.5 * 10))
 
         self.color = COLORS[random.randint(0, 5)]
-        self.image = pygame.draw.rect(screen, self.color, (int(self.x - self.a / 2),
-                                                           int(self.y - self.a / 2),
-                                                           self.a, self.a)
-                                      )
 
     def hit(self, event):
         hit = False
@@ -54,7 +109,9 @@ class Square:
             hit = True
         return hit
 
-    def move(self, screen):
+    def move(self):
+        """ Moves the square by one step of length dt.
+        """
         if self.x + self.a / 2 + self.vx * dt >= W_WIDTH or\
                 self.x - self.a / 2 + self.vx * dt <= 0:
             self.vx *= -1
@@ -71,14 +128,13 @@ class Square:
         self.vx = np.sign(self.vx) * min(abs(self.vx), self.points * 10)
         self.vy = np.sign(self.vy) * min(abs(self.vy), self.points * 10)
 
-        self.image = pygame.draw.rect(screen, self.color, (int(self.x - self.a / 2),
-                                                           int(self.y - self.a / 2),
-                                                           self.a, self.a)
-                                      )
+    def draw(self, screen):
+        return pygame.draw.rect(screen, self.color, (int(self.x - self.a / 2), int(self.y - self.a / 2),
+                                                     self.a, self.a))
 
 
 class Ball:
-    def __init__(self, screen, player_points):
+    def __init__(self, player_points):
         """ Creates a ball object based on how good the player is playing.
 
         points - number of points given to the player if the ball is hit.
@@ -86,9 +142,7 @@ class Ball:
         r - radius of the ball.
         vx, vy - velocity of the ball.
         color - color of the ball.
-        image - image of the ball.
 
-        :param screen: screen, on which the ball is drawn.
         :param player_points: number of points the player scored in the game.
         """
         self.points = random.randint(20, 50) + int((player_points / 5))
@@ -102,7 +156,6 @@ class Ball:
         self.vy = random.choice((-1, 1)) * random.randint(int(self.points * 20), 100 + int(self.points * 20))
 
         self.color = COLORS[random.randint(0, 5)]
-        self.image = pygame.draw.circle(screen, self.color, (self.x, self.y), self.r)
 
     def hit(self, event):
         hit = False
@@ -110,7 +163,9 @@ class Ball:
             hit = True
         return hit
 
-    def move(self, screen):
+    def move(self):
+        """ Moves the ball by one step of length dt.
+        """
         self.x += self.vx * dt
         self.y += self.vy * dt
 
@@ -120,14 +175,197 @@ class Ball:
         if self.y + self.r >= W_HEIGHT or self.y - self.r <= 0:
             self.vy *= -1
 
-        self.image = pygame.draw.circle(screen, self.color, (int(self.x), int(self.y)), self.r)
+    def draw(self, screen):
+        return pygame.draw.circle(screen, self.color, (int(self.x), int(self.y)), self.r)
+
+
+class TargetSwarm:
+    def __init__(self, capacity=64, seed=None):
+        """ Creates an empty store of moving targets for the arcade swarm mode. Targets are kept in numpy arrays and
+        moved all at once; a target of kind BALL behaves like a Ball and a target of kind SQUARE like a Square.
+
+        n - number of targets.
+        kind - BALL or SQUARE.
+        x, y - positions of the centers of the targets.
+        size - radius of a ball or length of the side of a square.
+        vx, vy - velocities of the targets.
+        points - number of points given to the player if the target is hit.
+        color - index of the color of the target in COLORS.
+
+        :param capacity: number of targets the arrays have room for. They grow when they are full.
+        :param seed: seed of the random number generator.
+        """
+        self.rng = np.random.default_rng(seed)
+        self.n = 0
+        self.kind = np.zeros(capacity, dtype=np.int8)
+        self.x = np.zeros(capacity)
+        self.y = np.zeros(capacity)
+        self.vx = np.zeros(capacity)
+        self.vy = np.zeros(capacity)
+        self.size = np.zeros(capacity, dtype=int)
+        self.points = np.zeros(capacity, dtype=int)
+        self.color = np.zeros(capacity, dtype=int)
+
+    def __len__(self):
+        return self.n
+
+    def add(self, kind, count, player_points):
+        """ Adds count new targets of the kind.
+
+        :param kind: BALL or SQUARE.
+        :param count: number of targets.
+        :param player_points: number of points the player scored in the game.
+        """
+        while self.n + count > len(self.kind):
+            for name in ("kind", "x", "y", "vx", "vy", "size", "points", "color"):
+                old = getattr(self, name)
+                new = np.zeros(2 * len(old), dtype=old.dtype)
+                new[:len(old)] = old
+                setattr(self, name, new)
+        idx = np.arange(self.n, self.n + count)
+        self.n += count
+        self.kind[idx] = kind
+        self.respawn(idx, player_points)
+
+    def respawn(self, idx, player_points):
+        """ Replaces the targets idx with new random targets of the same kinds, the way the constructors of Ball
+        and Square create them.
+
+        :param idx: indices of the targets.
+        :param player_points: number of points the player scored in the game.
+        """
+        rng = self.rng
+        k = len(idx)
+        ball = self.kind[idx] == BALL
+        points = np.where(ball, rng.integers(20, 50, k, endpoint=True) + int(player_points / 5),
+                          rng.integers(50, 100, k, endpoint=True) + int((player_points / 2) ** 0.5))
+        self.points[idx] = points
+        self.x[idx] = rng.integers(int(W_WIDTH * 0.1), int(W_WIDTH * 0.9), k, endpoint=True)
+        self.y[idx] = rng.integers(int(W_HEIGHT * 0.1), int(W_HEIGHT * 0.9), k, endpoint=True)
+        self.size[idx] = np.where(ball, (W_WIDTH + W_HEIGHT) // points, 2 * (W_WIDTH + W_HEIGHT) // points)
+
+        ball_speed = rng.integers(points * 20, 100 + points * 20, endpoint=True)
+        square_speed = (np.sqrt(points) * 10).astype(int)
+        self.vx[idx] = np.where(ball, rng.choice((-1, 1), k) * ball_speed,
+                                rng.integers(0, 100 + square_speed, endpoint=True))
+        ball_speed = rng.integers(points * 20, 100 + points * 20, endpoint=True)
+        self.vy[idx] = np.where(ball, rng.choice((-1, 1), k) * ball_speed,
+                                rng.integers(0, 100 + square_speed, endpoint=True))
+        self.color[idx] = rng.integers(0, len(COLORS), k)
+
+    def move(self):
+        """ Moves all the targets by one step, as Ball.move and Square.move do, without drawing them.
+        """
+        n = self.n
+        x, y, vx, vy = self.x[:n], self.y[:n], self.vx[:n], self.vy[:n]
+        size = self.size[:n]
+        ball = self.kind[:n] == BALL
+        square = ~ball
+
+        half = size / 2
+        vx[square & ((x + half + vx * dt >= W_WIDTH) | (x - half + vx * dt <= 0))] *= -1
+        vy[square & ((y + half + vy * dt >= W_HEIGHT) | (y - half + vy * dt <= 0))] *= -1
+
+        x += vx * dt
+        y += vy * dt
+
+        vx[ball & ((x + size >= W_WIDTH) | (x - size <= 0))] *= -1
+        vy[ball & ((y + size >= W_HEIGHT) | (y - size <= 0))] *= -1
+
+        idx = np.flatnonzero(square)
+        points = self.points[idx]
+        jitter = 50 + points
+        for v in (vx, vy):
+            v[idx] += self.rng.integers(-jitter, jitter, endpoint=True)
+            v[idx] = np.sign(v[idx]) * np.minimum(np.abs(v[idx]), points * 10)
+
+    def bounds(self):
+        """
+        :return: (x_min, y_min, x_max, y_max) arrays with the bounding boxes of the targets.
+        """
+        n = self.n
+        half = np.where(self.kind[:n] == BALL, self.size[:n], self.size[:n] / 2)
+        return self.x[:n] - half, self.y[:n] - half, self.x[:n] + half, self.y[:n] + half
+
+    def hit(self, pos, grid=None):
+        """ Finds the targets under the point pos.
+
+        :param pos: position of the click.
+        :param grid: TargetGrid built from the bounds of the targets. If it is given, only the targets it finds
+        near pos are checked, otherwise all of them are.
+        :return: indices of the targets, which are hit.
+        """
+        idx = np.arange(self.n) if grid is None else grid.query(pos)
+        dx = self.x[idx] - pos[0]
+        dy = self.y[idx] - pos[1]
+        size = self.size[idx]
+        ball = self.kind[idx] == BALL
+        hit = np.where(ball, dx ** 2 + dy ** 2 <= size ** 2,
+                       (np.abs(dx) <= size / 2) & (np.abs(dy) <= size / 2))
+        return idx[hit]
+
+    def draw(self, screen):
+        n = self.n
+        x = self.x[:n].tolist()
+        y = self.y[:n].tolist()
+        size = self.size[:n].tolist()
+        kind = self.kind[:n].tolist()
+        color = self.color[:n].tolist()
+        for i in range(n):
+            if kind[i] == BALL:
+                pygame.draw.circle(screen, COLORS[color[i]], (int(x[i]), int(y[i])), size[i])
+            else:
+                pygame.draw.rect(screen, COLORS[color[i]], (int(x[i] - size[i] / 2), int(y[i] - size[i] / 2),
+                                                             size[i], size[i]))
+
+
+class TargetGrid:
+    def __init__(self, cell_size=64):
+        """ Creates an empty uniform grid over the window for finding the targets under a click. Every target is
+        put into all the cells its bounding box covers, so a click only has to look at one cell.
+
+        :param cell_size: length of the side of a cell.
+        """
+        self.cell_size = cell_size
+        self.n_cols = W_WIDTH // cell_size + 1
+        self.n_rows = W_HEIGHT // cell_size + 1
+        self.items = np.zeros(0, dtype=int)
+        self.starts = np.zeros(self.n_cols * self.n_rows + 1, dtype=int)
+        # With few cells the keys fit into int16, which numpy sorts with a linear time radix sort.
+        self.key_type = np.int16 if self.n_cols * self.n_rows <= np.iinfo(np.int16).max + 1 else np.int32
+
+    def rebuild(self, x_min, y_min, x_max, y_max):
+        """ Puts the targets into the cells. Called before a click is resolved, if the targets have moved.
+
+        :param x_min, y_min, x_max, y_max: arrays with the bounding boxes of the targets.
+        """
+        cs = self.cell_size
+        col_0 = np.clip(x_min // cs, 0, self.n_cols - 1).astype(int)
+        col_1 = np.clip(x_max // cs, 0, self.n_cols - 1).astype(int)
+        row_0 = np.clip(y_min // cs, 0, self.n_rows - 1).astype(int)
+        row_1 = np.clip(y_max // cs, 0, self.n_rows - 1).astype(int)
+        width = col_1 - col_0 + 1
+        counts = width * (row_1 - row_0 + 1)
+        owner = np.repeat(np.arange(len(counts)), counts)
+        local = np.arange(len(owner)) - np.repeat(np.cumsum(counts) - counts, counts)
+        keys = (row_0[owner] + local // width[owner]) * self.n_cols + col_0[owner] + local % width[owner]
+        self.items = owner[np.argsort(keys.astype(self.key_type), kind="stable")]
+        self.starts[1:] = np.cumsum(np.bincount(keys, minlength=self.n_cols * self.n_rows))
+
+    def query(self, pos):
+        """
+        :param pos: point in the window.
+        :return: indices of the targets, whose bounding boxes may contain the point.
+        """
+        col = min(max(int(pos[0]) // self.cell_size, 0), self.n_cols - 1)
+        row = min(max(int(pos[1]) // self.cell_size, 0), self.n_rows - 1)
+        key = row * self.n_cols + col
+        return self.items[self.starts[key]:self.starts[key + 1]]
 
 
 class RussellTeapot:
-    def __init__(self, screen):
+    def __init__(self):
         """ Creates teapot, which cannot be hit.
-
-        :param screen: screen, on which the teapot is drawn.
         """
         self.x = random.randint(int(W_WIDTH * 0.1), int(W_WIDTH * 0.9))
         self.y = random.randint(int(W_HEIGHT * 0.1), int(W_HEIGHT * 0.9))
@@ -136,10 +374,9 @@ class RussellTeapot:
 
         self.color = COLORS[random.randint(0, 5)]
 
-        self.image = pygame.image.load("teapot.png")
+        self.image = assets.get("teapot.png")
         self.a = self.image.get_width()
         self.b = self.image.get_height()
-        screen.blit(self.image, (self.x, self.y))
 
     def almost_hit(self, event):
         hit = False
@@ -158,32 +395,121 @@ class RussellTeapot:
             self.y %= W_HEIGHT
 
     def draw(self, screen):
-        screen.blit(self.image, (int(self.x - self.a/2), int(self.y - self.b/2)))
+        return screen.blit(self.image, (int(self.x - self.a/2), int(self.y - self.b/2)))
 
 
-def write_to_file(points):
-    """Writes points, scored in this game, to file data.txt.
+class ScoreStore:
+    def __init__(self, path="scores.db", legacy_path="data.txt"):
+        """ Opens the SQLite database with the scores of all the games, creating it if it does not exist.
+        Scores are indexed, so the highest ones are found without reading the others.
 
-    :param points: points scored in one game.
-    """
-    output = open("data.txt", 'a')
-    print(points, file=output)
-    output.close()
+        :param path: path of the database.
+        :param legacy_path: text file with one score per line, written by old versions of the game. Its scores are
+        moved into the database when it is seen.
+        """
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS scores "
+                                    "(id INTEGER PRIMARY KEY, points INTEGER NOT NULL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS scores_points ON scores (points)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS imported_files "
+                                    "(path TEXT, size INTEGER, mtime_ns INTEGER, PRIMARY KEY (path, size, mtime_ns))")
+        if legacy_path is not None and os.path.exists(legacy_path):
+            self.migrate(legacy_path)
+
+    def migrate(self, legacy_path):
+        """ Moves the scores from a text file into the database in one pass over the file, without loading it
+        whole. The file is renamed afterwards, to a name no other file has. The file is recorded by its path, size
+        and modification time in the same transaction as its scores, so they are never added twice, while a new
+        file at the same path is imported again.
+
+        :param legacy_path: text file with one score per line.
+        """
+        stat = os.stat(legacy_path)
+        key = (os.path.abspath(legacy_path), stat.st_size, stat.st_mtime_ns)
+        done = self.connection.execute("SELECT 1 FROM imported_files WHERE path = ? AND size = ? AND mtime_ns = ?",
+                                       key).fetchone()
+        if done is None:
+            with open(legacy_path) as inp, self.connection:
+                self.connection.executemany("INSERT INTO scores (points) VALUES (?)",
+                                            ((int(line),) for line in inp if line.strip()))
+                self.connection.execute("INSERT INTO imported_files (path, size, mtime_ns) VALUES (?, ?, ?)", key)
+        backup = legacy_path + ".migrated"
+        i = 0
+        while os.path.exists(backup):
+            i += 1
+            backup = "%s.migrated.%d" % (legacy_path, i)
+        os.rename(legacy_path, backup)
+
+    def submit(self, points):
+        """ Saves points, scored in one game.
+
+        :param points: points scored in one game.
+        """
+        with self.connection:
+            self.connection.execute("INSERT INTO scores (points) VALUES (?)", (points,))
 
+    def best(self):
+        """
+        :return: maximum of all the points saved, 0 if there are none.
+        """
+        return self.connection.execute("SELECT MAX(points) FROM scores").fetchone()[0] or 0
+
+    def top(self, n=10):
+        """
+        :param n: length of the leaderboard.
+        :return: list of the n highest scores, the highest first.
+        """
+        rows = self.connection.execute("SELECT points FROM scores ORDER BY points DESC LIMIT ?", (n,))
+        return [points for points, in rows]
+
+    def close(self):
+        self.connection.close()
+
+
+_fonts = {}
 
-def read_from_file():
-    """Searches for the highest score in file.
 
-    :return: maximum of all the points written in data.txt.
+def get_font(name, size):
+    """Returns a system font. Each font is looked up only the first time it is asked for.
+
+    :param name: name of the font.
+    :param size: size of the font.
     """
-    inp = open("data.txt", 'r')
+    key = (name, size)
+    if key not in _fonts:
+        if not _fonts:
+            # Fonts die with pygame.quit(); forget them then, so that the next game loads them again.
+            pygame.register_quit(_fonts.clear)
+        _fonts[key] = pygame.font.SysFont(name, size)
+    return _fonts[key]
+
+
+class Label:
+    def __init__(self, prefix, font_name='Comic Sans MS', size=30, color=(200, 200, 200)):
+        """ Creates text of the form prefix + value, which is rendered again only when the value changes.
+
+        :param prefix: constant part of the text.
+        :param font_name: name of the font.
+        :param size: size of the font.
+        :param color: color of the text.
+        """
+        self.prefix = prefix
+        self.font_name = font_name
+        self.size = size
+        self.color = color
+        self.value = None
+        self.surface = None
 
-    max_points = 0
-    for line in inp:
-        if int(line) > max_points:
-            max_points = int(line)
+    def draw(self, screen, value, pos):
+        if self.surface is None or value != self.value:
+            self.value = value
+            self.surface = get_font(self.font_name, self.size).render(self.prefix + str(value), False, self.color)
+        screen.blit(self.surface, pos)
 
-    return max_points
+
+max_points_label = Label("Highest score: ")
+points_label = Label("Score: ")
 
 
 def display_score(screen, max_points, points):
@@ -193,37 +519,87 @@ def display_score(screen, max_points, points):
     :param max_points: highest point ever scored.
     :param points: points scored in this game.
     """
-    font = pygame.font.SysFont('Comic Sans MS', 30)
+    max_points_label.draw(screen, max_points, (0, 0))
+    points_label.draw(screen, points, (0, 50))
 
-    text_max_points = font.render("Highest score: " + str(max_points),
-                                  False, (200, 200, 200))
-    text_points = font.render("Score: " + str(points),
-                              False, (200, 200, 200))
-    screen.blit(text_max_points, (0, 0))
-    screen.blit(text_points, (0, 50))
 
+def update(balls, squares, targets=None):
+    """ Moves all the targets by one step of length dt. Nothing is drawn, so the game can be simulated without a
+    screen.
 
-def main():
+    :param balls: list of balls.
+    :param squares: list of squares.
+    :param targets: TargetSwarm of the arcade swarm mode, or None.
+    """
+    for ball in balls:
+        ball.move()
+    for square in squares:
+        square.move()
+    if targets is not None:
+        targets.move()
+
+
+def render(screen, balls, squares, targets, russell_teapots, max_points, points):
+    """ Draws a frame and shows it.
+
+    :param screen: screen, on which the game is being drawn.
+    :param balls: list of balls.
+    :param squares: list of squares.
+    :param targets: TargetSwarm of the arcade swarm mode, or None.
+    :param russell_teapots: list of teapots.
+    :param max_points: highest point ever scored.
+    :param points: points scored in this game.
+    """
+    screen.fill(BLACK)
+    display_score(screen, max_points, points)
+    for ball in balls:
+        ball.draw(screen)
+    for square in squares:
+        square.draw(screen)
+    if targets is not None:
+        targets.draw(screen)
+    for russell_teapot in russell_teapots:
+        russell_teapot.draw(screen)
+    pygame.display.update()
+
+
+def main(swarm=0):
+    """ Runs the game.
+
+    :param swarm: number of targets in the arcade swarm mode. If it is 0, the game has one ball and two squares.
+    """
     pygame.init()
+    assets.preload(["teapot.png"])
     screen = pygame.display.set_mode((W_WIDTH, W_HEIGHT))
     pygame.display.update()
     clock = pygame.time.Clock()
     finished = False
 
     points = 0
-    balls = [Ball(screen, points) for i in range(1)]
-    squares = [Square(screen, points) for i in range(2)]
-    russell_teapots = [RussellTeapot(screen) for i in range(1)]
-
-    output = open("data.txt", 'a')
-    output.close()
-
-    max_points = read_from_file()
-
+    targets = None
+    grid = TargetGrid()
+    # The grid is stale when the targets have moved or been respawned since it was built. It is only rebuilt when a
+    # click needs it, so frames without clicks do not pay for it.
+    stale = False
+    if swarm:
+        balls, squares = [], []
+        targets = TargetSwarm()
+        targets.add(BALL, swarm // 2, points)
+        targets.add(SQUARE, swarm - swarm // 2, points)
+        grid.rebuild(*targets.bounds())
+    else:
+        balls = [Ball(points) for i in range(1)]
+        squares = [Square(points) for i in range(2)]
+    russell_teapots = [RussellTeapot() for i in range(1)]
+
+    store = ScoreStore()
+    max_points = store.best()
+
+    accumulator = 0.
+    skipped = 0
     while not finished:
-        clock.tick(FPS)
+        accumulator += clock.tick(FPS) / 1000
 
-        display_score(screen, max_points, points)
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 finished = True
@@ -232,35 +608,56 @@ def main():
                 hit = False
                 for ball in balls:
                     if ball.hit(event):
-                        balls[i] = Ball(screen, points)
+                        balls[i] = Ball(points)
                         points += ball.points
                         hit = True
                     i += 1
                 i = 0
                 for square in squares:
                     if square.hit(event):
-                        squares[i] = Square(screen, points)
+                        squares[i] = Square(points)
                         points += square.points
                         hit = True
                     i += 1
+                if targets is not None:
+                    if stale and targets.n <= MAX_GRID_TARGETS:
+                        grid.rebuild(*targets.bounds())
+                        stale = False
+                    for i in targets.hit(event.pos, None if stale else grid):
+                        gained = int(targets.points[i])
+                        targets.respawn([i], points)
+                        points += gained
+                        hit = True
+                        stale = True
                 if not hit:
                     points = max(0, points - 100)
             elif event.type == pygame.MOUSEMOTION:
                 for russell_teapot in russell_teapots:
                     russell_teapot.change_coords(event)
-        for ball in balls:
-            ball.move(screen)
-        for square in squares:
-            square.move(screen)
-        for russell_teapot in russell_teapots:
-            russell_teapot.draw(screen)
-        pygame.display.update()
-        screen.fill(BLACK)
 
-    write_to_file(points)
+        steps = min(int(accumulator * STEPS_PER_SECOND), MAX_STEPS_PER_FRAME)
+        accumulator -= steps / STEPS_PER_SECOND
+        for i in range(steps):
+            update(balls, squares, targets)
+        if steps:
+            stale = True
+
+        # When the game falls behind, a few frames are not drawn to give the time to the simulation.
+        if accumulator >= 1 / STEPS_PER_SECOND and skipped < MAX_SKIPPED_FRAMES:
+            skipped += 1
+        else:
+            render(screen, balls, squares, targets, russell_teapots, max_points, points)
+            skipped = 0
+        accumulator = min(accumulator, MAX_STEPS_PER_FRAME / STEPS_PER_SECOND)
+
+    store.submit(points)
+    store.close()
 
     pygame.quit()
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Ball game.")
+    parser.add_argument("--swarm", type=int, default=0, help="number of targets in the arcade swarm mode")
+    args = parser.parse_args()
+    main(swarm=args.swarm)
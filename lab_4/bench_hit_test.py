@@ -0,0 +1,86 @@
+"""
+Benchmark of finding the targets under a click in ball_game.
+
+Three ways are compared: the linear scan of main, which calls hit() on every Ball and Square object; the
+vectorized scan of TargetSwarm, which tests all the targets at once; and TargetSwarm with a TargetGrid, which
+tests only the targets in the cell of the click. The time of the rebuild is shown separately: the game rebuilds
+the grid before the first click after the targets have moved, and scans all the targets instead when there are
+more than MAX_GRID_TARGETS of them.
+"""
+import argparse
+from time import perf_counter
+
+import numpy as np
+import pygame
+
+import ball_game
+
+
+def percentiles(times):
+    return np.percentile(np.array(times) * 1e6, [50, 99])
+
+
+def linear_scan(n, clicks):
+    """
+    Returns the click times in seconds of the scan over n Ball and Square objects.
+    """
+    objects = [ball_game.Ball(0) for i in range(n // 2)] + \
+              [ball_game.Square(0) for i in range(n - n // 2)]
+    times = []
+    for pos in clicks:
+        event = pygame.event.Event(pygame.MOUSEBUTTONDOWN, pos=pos, button=1)
+        start = perf_counter()
+        [target for target in objects if target.hit(event)]
+        times.append(perf_counter() - start)
+    return times
+
+
+def swarm_scan(swarm, clicks, grid=None):
+    """
+    Returns the click times in seconds of TargetSwarm.hit, with or without the grid.
+    """
+    times = []
+    for pos in clicks:
+        start = perf_counter()
+        swarm.hit(pos, grid)
+        times.append(perf_counter() - start)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the ways of finding the targets under a click.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 100000], help="numbers of targets")
+    parser.add_argument("--clicks", type=int, default=200, help="number of clicks")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the targets and the clicks")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    clicks = list(zip(rng.integers(0, ball_game.W_WIDTH, args.clicks).tolist(),
+                      rng.integers(0, ball_game.W_HEIGHT, args.clicks).tolist()))
+
+    print("%8s %24s %24s %24s %12s" % ("targets", "linear p50/p99 us", "vectorized p50/p99 us", "grid p50/p99 us",
+                                       "rebuild us"))
+    for n in args.sizes:
+        swarm = ball_game.TargetSwarm(capacity=n, seed=args.seed)
+        swarm.add(ball_game.BALL, n // 2, 0)
+        swarm.add(ball_game.SQUARE, n - n // 2, 0)
+        grid = ball_game.TargetGrid()
+        rebuilds = []
+        for i in range(10):
+            start = perf_counter()
+            grid.rebuild(*swarm.bounds())
+            rebuilds.append(perf_counter() - start)
+
+        expected = [sorted(swarm.hit(pos).tolist()) for pos in clicks]
+        found = [sorted(swarm.hit(pos, grid).tolist()) for pos in clicks]
+        assert found == expected, "the grid missed some targets"
+
+        linear = percentiles(linear_scan(n, clicks))
+        vectorized = percentiles(swarm_scan(swarm, clicks))
+        indexed = percentiles(swarm_scan(swarm, clicks, grid))
+        print("%8d %11.1f / %10.1f %11.1f / %10.1f %11.1f / %10.1f %12.1f"
+              % (n, *linear, *vectorized, *indexed, np.median(rebuilds) * 1e6))
+
+
+if __name__ == "__main__":
+    main()
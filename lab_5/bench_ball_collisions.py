@@ -0,0 +1,85 @@
+"""
+Benchmark of the collisions between balls: sweep and prune against checking all the pairs.
+
+Balls are scattered with a constant density, so the number of touching pairs grows linearly with the number of
+balls. Every frame the balls move a little, the broad phase finds the candidate pairs and collide_balls resolves
+them. The slope of log(time) against log(number of balls) shows how the method scales: 1 is linear, 2 quadratic.
+"""
+import argparse
+from time import perf_counter
+
+import numpy as np
+
+import gun
+
+
+def scatter(n, density, rng, rad=15):
+    """
+    Returns a BallArray with n balls placed at random with density balls per pixel.
+    """
+    side = (n / density) ** 0.5
+    balls = gun.BallArray(capacity=n)
+    balls.add_many(rng.uniform(0, side, (n, 2)), rng.normal(0, 3, (n, 2)), rad=rad)
+    return balls
+
+
+def all_pairs(balls):
+    """
+    Returns every pair of balls. Used as the quadratic baseline.
+    """
+    return np.triu_indices(len(balls), k=1)
+
+
+def run(balls, broad_phase, frames):
+    """
+    Moves the balls and resolves their collisions for some frames.
+
+    :return: mean time of a frame in seconds and the number of touching pairs in the last frame.
+    """
+    n = len(balls)
+    contacts = 0
+    start = perf_counter()
+    for frame in range(frames):
+        balls.coords[:n] += balls.vel[:n] * gun.TIME_STEP
+        contacts = gun.collide_balls(balls, *broad_phase(balls))
+    return (perf_counter() - start) / frames, contacts
+
+
+def slope(sizes, times):
+    return np.polyfit(np.log(sizes), np.log(times), 1)[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scaling of ball-ball collisions.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[250, 500, 1000, 2000, 4000, 8000, 16000])
+    parser.add_argument("--brute-max", type=int, default=2000, help="largest number of balls for all pairs")
+    parser.add_argument("--density", type=float, default=1 / 2500, help="balls per pixel")
+    parser.add_argument("--frames", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print("%8s %14s %14s %10s" % ("balls", "sap ms/frame", "all ms/frame", "contacts"))
+    sap_times = []
+    brute_sizes = []
+    brute_times = []
+    for n in args.sizes:
+        sap = gun.SweepAndPrune()
+        sap_time, contacts = run(scatter(n, args.density, np.random.default_rng(args.seed)), sap.pairs, args.frames)
+        sap_times.append(sap_time)
+        brute = ""
+        if n <= args.brute_max:
+            brute_time, brute_contacts = run(scatter(n, args.density, np.random.default_rng(args.seed)), all_pairs,
+                                             args.frames)
+            assert brute_contacts == contacts, "sweep and prune lost some contacts"
+            brute_sizes.append(n)
+            brute_times.append(brute_time)
+            brute = "%.3f" % (brute_time * 1000)
+        print("%8d %14.3f %14s %10d" % (n, sap_time * 1000, brute, contacts))
+
+    print("scaling exponent, sweep and prune: %.2f" % slope(args.sizes, sap_times))
+    if len(brute_sizes) > 1:
+        print("scaling exponent, all pairs: %.2f" % slope(brute_sizes, brute_times))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""
+Stress and scaling benchmark of the gun game.
+
+Manager is run without a window on synthetic levels with N balls, M walls and K targets, and every one of them is
+varied over orders of magnitude while the others stay at their base values. For each load the frame time of the
+phases (move, collisions, draw, ...) is measured with FrameProfiler, and the memory taken by a ball, a wall and a
+target is measured with tracemalloc. The sprite cache is measured apart, with few ball colors and with more
+colors than it holds. The results are printed as scaling curves and written to a JSON file.
+Two JSON files can be compared to find regressions between versions:
+
+    python benchmark.py --out new.json
+    python benchmark.py --compare old.json new.json
+"""
+import argparse
+import json
+import platform
+import sys
+import tracemalloc
+from time import perf_counter, strftime
+
+import numpy as np
+import pygame as pg
+
+import gun
+
+BASE = {"balls": 100, "walls": 5, "targets": 3}
+SCALES = {"balls": [10, 100, 1000, 10000], "walls": [5, 50, 500], "targets": [3, 30, 300]}
+PHASES = ("collisions", "alive", "move", "draw")
+
+
+def random_balls(balls, n, rng):
+    """
+    Adds n balls at random places with random velocities to the BallArray balls. Returns balls.
+    """
+    coords = rng.uniform([20, 20], [gun.SCREEN_SIZE[0] - 20, gun.SCREEN_SIZE[1] - 20], (n, 2))
+    vel = rng.uniform(-20, 20, (n, 2))
+    colors = rng.integers(0, 256, (n, 3))
+    balls.add_many(coords, vel, color=colors)
+    return balls
+
+
+def synthetic_manager(n_balls, n_walls, n_targets, seed=0):
+    """
+    Creates a Manager with a level of n_walls walls and n_targets targets at random places and n_balls balls.
+    """
+    rng = np.random.default_rng(seed)
+    manager = gun.Manager(seed=seed, profiler=gun.FrameProfiler(overlay=False))
+    manager.walls = [gun.Wall(100, 25, angle=a, coords=c) for a, c in
+                     zip(rng.uniform(-np.pi / 2, np.pi / 2, n_walls),
+                         rng.integers([100, 100], [gun.SCREEN_SIZE[0] - 100, gun.SCREEN_SIZE[1] - 100], (n_walls, 2)))]
+    manager.wall_rects = gun.wall_rects(manager.walls)
+    manager.targets = [gun.Target(list(c), rad=15, color=(200, 50, 50)) for c in
+                       rng.integers([100, 30], [gun.SCREEN_SIZE[0] - 30, gun.SCREEN_SIZE[1] - 30], (n_targets, 2))]
+    random_balls(manager.balls, n_balls, rng)
+    return manager, rng
+
+
+def measure_frames(n_balls, n_walls, n_targets, frames, seed=0):
+    """
+    Runs frames frames with a constant load: balls that died are replaced and targets that were hit come back.
+
+    :return: dictionary phase -> {"mean", "p50", "p95", "p99"} in milliseconds per frame.
+    """
+    manager, rng = synthetic_manager(n_balls, n_walls, n_targets, seed)
+    targets = list(manager.targets)
+    screen = pg.Surface(gun.SCREEN_SIZE)
+    profiler = manager.profiler
+    for frame in range(frames):
+        manager.process([], screen, mouse_pos=(400, 300))
+        for target in targets:
+            target.is_alive = True
+        manager.targets = list(targets)
+        if len(manager.balls) < n_balls:
+            random_balls(manager.balls, n_balls - len(manager.balls), rng)
+
+    n = min(profiler.frames, profiler.window)
+    result = {}
+    for phase in PHASES:
+        times = profiler.times[phase][:n] / 1e6
+        p50, p95, p99 = np.percentile(times, [50, 95, 99])
+        result[phase] = {"mean": float(times.mean()), "p50": float(p50), "p95": float(p95), "p99": float(p99)}
+    return result
+
+
+def measure_memory(count=10000):
+    """
+    Returns the number of bytes allocated for one ball, one wall and one target, averaged over count of them.
+    """
+    def allocated(make):
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        kept = make()
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del kept
+        return (after - before) / count
+
+    rng = np.random.default_rng(0)
+    return {"ball": allocated(lambda: random_balls(gun.BallArray(capacity=count), count, rng)),
+            "wall": allocated(lambda: [gun.Wall(100, 25, angle=0.5, coords=[400, 300]) for i in range(count)]),
+            "target": allocated(lambda: [gun.Target([400, 300], color=gun.BLACK) for i in range(count)])}
+
+
+def measure_sprites(frames, n_balls=2000, palettes=(8, 2000), seed=0):
+    """
+    Draws n_balls balls, which take their colors from a palette of the given size, frames times.
+
+    :return: dictionary palette size -> {"ms" per frame, "hits", "misses", "bypassed"} of a fresh SpriteCache.
+    """
+    rng = np.random.default_rng(seed)
+    screen = pg.Surface(gun.SCREEN_SIZE)
+    result = {}
+    for size in palettes:
+        balls = gun.BallArray(capacity=n_balls)
+        random_balls(balls, n_balls, rng)
+        balls.color[:n_balls] = rng.integers(0, 256, (size, 3))[rng.integers(0, size, n_balls)]
+        cache = gun.SpriteCache()
+        gun.sprites, saved = cache, gun.sprites
+        try:
+            start = perf_counter()
+            for frame in range(frames):
+                balls.draw(screen)
+            elapsed = perf_counter() - start
+        finally:
+            gun.sprites = saved
+        result[size] = {"ms": elapsed / frames * 1e3, "hits": cache.hits, "misses": cache.misses,
+                        "bypassed": cache.bypassed}
+    return result
+
+
+def run_suite(frames, scales=SCALES):
+    """
+    Measures every load of scales.
+
+    :return: dictionary with the environment, the memory per entity and the scaling curves.
+    """
+    curves = {}
+    for axis, values in scales.items():
+        curves[axis] = []
+        for value in values:
+            load = dict(BASE, **{axis: value})
+            phases = measure_frames(load["balls"], load["walls"], load["targets"], frames)
+            curves[axis].append({"load": load, "phases": phases})
+            print_row(axis, value, phases)
+    return {"time": strftime("%Y-%m-%d %H:%M:%S"),
+            "python": sys.version.split()[0],
+            "numpy": np.__version__,
+            "pygame": pg.version.ver,
+            "machine": platform.platform(),
+            "frames": frames,
+            "memory": measure_memory(),
+            "sprites": measure_sprites(frames),
+            "curves": curves}
+
+
+def print_row(axis, value, phases):
+    cells = " ".join("%10.3f" % phases[phase]["mean"] for phase in PHASES)
+    print("%-8s %7d %s" % (axis, value, cells))
+
+
+def compare(old_path, new_path, threshold):
+    """
+    Prints the ratio of the new frame times to the old ones for every load and phase.
+
+    :return: True if some phase got slower than threshold times.
+    """
+    with open(old_path) as inp:
+        old = json.load(inp)
+    with open(new_path) as inp:
+        new = json.load(inp)
+    regressed = False
+    print("%-8s %7s %s" % ("axis", "value", " ".join("%10s" % phase for phase in PHASES)))
+    for axis, new_points in new["curves"].items():
+        old_points = {json.dumps(p["load"], sort_keys=True): p for p in old["curves"].get(axis, [])}
+        for point in new_points:
+            old_point = old_points.get(json.dumps(point["load"], sort_keys=True))
+            if old_point is None:
+                continue
+            cells = []
+            for phase in PHASES:
+                before = old_point["phases"][phase]["p50"]
+                after = point["phases"][phase]["p50"]
+                ratio = after / before if before > 0 else 1.
+                mark = "!" if ratio > threshold else " "
+                regressed |= ratio > threshold
+                cells.append("%9.2fx%s" % (ratio, mark))
+            print("%-8s %7d %s" % (axis, point["load"][axis], "".join(cells)))
+    for entity, size in new["memory"].items():
+        print("memory per %s: %.0f -> %.0f bytes" % (entity, old["memory"].get(entity, 0), size))
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stress and scaling benchmark of the gun game.")
+    parser.add_argument("--frames", type=int, default=60, help="number of frames for every load")
+    parser.add_argument("--out", default="benchmark.json", help="file to write the results to")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files")
+    parser.add_argument("--threshold", type=float, default=1.2, help="slowdown reported as a regression")
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(args.compare[0], args.compare[1], args.threshold) else 0)
+
+    pg.font.init()
+    print("milliseconds per frame")
+    print("%-8s %7s %s" % ("axis", "value", " ".join("%10s" % phase for phase in PHASES)))
+    results = run_suite(args.frames)
+    for entity, size in results["memory"].items():
+        print("memory per %s: %.0f bytes" % (entity, size))
+    for size, stats in results["sprites"].items():
+        print("sprites, %d colors: %.3f ms per frame, %d hits, %d misses, %d drawn without the cache"
+              % (size, stats["ms"], stats["hits"], stats["misses"], stats["bypassed"]))
+    with open(args.out, "w") as output:
+        json.dump(results, output, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,71 +1,681 @@
+import argparse
+import copy
+import csv
+import hashlib
+import json
+import math
+import random
+import struct
+import sys
+import tempfile
+import threading
+from collections import OrderedDict, deque
+from time import perf_counter, perf_counter_ns, sleep
+
 import pygame as pg
 import numpy as np
-from random import randint
 
 FPS = 60
 SCREEN_SIZE = [800, 600]
 TIME_STEP = 0.5
+SIM_RATE = 60
+MAX_TICKS_PER_FRAME = 5
+MAX_CONTACTS = 4
+CONTACT_GAP = 1e-6
 
 BLACK = (0, 0, 0)
 RED = (255, 0, 0)
 YELLOW = (255, 255, 0)
+GREY = (120, 120, 120)
+
+
+def sweep_circle_rect(start, shift, rad, centre, normal, parallel, half_width, half_length):
+    """
+    Finds when circles moving along straight segments first touch an oriented rectangle. The arguments are arrays,
+    which are broadcast against each other, so one call handles many circles (and many rectangles).
+
+    :param start: (n, 2) positions of the centres of the circles at the beginning of the step.
+    :param shift: (n, 2) displacements of the circles during the step.
+    :param rad: radii of the circles.
+    :param centre: centre of the rectangle.
+    :param normal: unit vector along the width of the rectangle.
+    :param parallel: unit vector along the length of the rectangle.
+    :param half_width: half of the width of the rectangle.
+    :param half_length: half of the length of the rectangle.
+    :return: (toi, contact_normal, depth). toi is the fraction of the step after which the circle touches the
+     rectangle, inf if it does not. contact_normal points from the rectangle to the circle. depth is how deep the
+     circle is inside the rectangle if it already overlaps it at the beginning of the step (then toi = 0).
+    """
+    rel = start - centre
+    u0 = np.sum(rel * normal, axis=-1)
+    v0 = np.sum(rel * parallel, axis=-1)
+    du = np.sum(shift * normal, axis=-1)
+    dv = np.sum(shift * parallel, axis=-1)
+    rad = np.broadcast_to(np.asarray(rad, dtype=float), u0.shape)
+    hw = np.broadcast_to(half_width, u0.shape)
+    hl = np.broadcast_to(half_length, u0.shape)
+
+    def slab(p0, d, extent):
+        inside = np.abs(p0) <= extent
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t1 = (-extent - p0) / d
+            t2 = (extent - p0) / d
+        t_near = np.where(d != 0, np.minimum(t1, t2), np.where(inside, -np.inf, np.inf))
+        t_far = np.where(d != 0, np.maximum(t1, t2), np.where(inside, np.inf, -np.inf))
+        return t_near, t_far
+
+    tu_near, tu_far = slab(u0, du, hw + rad)
+    tv_near, tv_far = slab(v0, dv, hl + rad)
+    t_enter = np.maximum(tu_near, tv_near)
+    t_exit = np.minimum(tu_far, tv_far)
+    touches_box = (t_enter <= t_exit) & (t_exit >= 0) & (t_enter <= 1)
+
+    toi = np.full(u0.shape, np.inf)
+    nu = np.zeros(u0.shape)
+    nv = np.zeros(u0.shape)
+    depth = np.zeros(u0.shape)
+
+    # The circle already overlaps the rectangle: push it out the shortest way.
+    started_inside = touches_box & (t_enter < 0)
+    gu = u0 - np.clip(u0, -hw, hw)
+    gv = v0 - np.clip(v0, -hl, hl)
+    dist = np.hypot(gu, gv)
+    centre_inside = started_inside & (dist == 0)
+    across_u = centre_inside & (hw - np.abs(u0) <= hl - np.abs(v0))
+    across_v = centre_inside & ~across_u
+    nu[across_u] = np.where(u0[across_u] < 0, -1., 1.)
+    depth[across_u] = hw[across_u] - np.abs(u0[across_u]) + rad[across_u]
+    nv[across_v] = np.where(v0[across_v] < 0, -1., 1.)
+    depth[across_v] = hl[across_v] - np.abs(v0[across_v]) + rad[across_v]
+    overlaps = started_inside & (dist > 0) & (dist < rad)
+    nu[overlaps] = gu[overlaps] / dist[overlaps]
+    nv[overlaps] = gv[overlaps] / dist[overlaps]
+    depth[overlaps] = rad[overlaps] - dist[overlaps]
+    toi[centre_inside | overlaps] = 0
+
+    # The circle enters the expanded rectangle through one of its faces.
+    t = np.where(touches_box & (t_enter >= 0), t_enter, 0)
+    pu = u0 + t * du
+    pv = v0 + t * dv
+    enters = touches_box & (t_enter >= 0)
+    face = enters & ((np.abs(pu) <= hw) | (np.abs(pv) <= hl))
+    face_u = face & (tu_near >= tv_near)
+    face_v = face & ~face_u
+    nu[face_u] = -np.sign(du[face_u])
+    nv[face_v] = -np.sign(dv[face_v])
+    toi[face] = t_enter[face]
+
+    # The circle gets close to a vertex: intersect its path with a circle around the vertex.
+    corner = (enters & ~face) | (started_inside & (dist >= rad))
+    cu = np.where(enters, np.sign(pu), np.sign(u0)) * hw
+    cv = np.where(enters, np.sign(pv), np.sign(v0)) * hl
+    wu = u0 - cu
+    wv = v0 - cv
+    a = du ** 2 + dv ** 2
+    b = wu * du + wv * dv
+    c = wu ** 2 + wv ** 2 - rad ** 2
+    disc = b ** 2 - a * c
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t_corner = (-b - np.sqrt(np.maximum(disc, 0))) / a
+    corner &= (a > 0) & (b < 0) & (disc >= 0) & (t_corner >= 0) & (t_corner <= 1)
+    toi[corner] = t_corner[corner]
+    nu[corner] = (wu + t_corner * du)[corner] / rad[corner]
+    nv[corner] = (wv + t_corner * dv)[corner] / rad[corner]
+
+    contact_normal = nu[..., None] * normal + nv[..., None] * parallel
+    return toi, contact_normal, depth
+
+
+def sweep_pairs(coords, vel, rad, shift, pair_ball, pair_wall, rects, max_contacts=MAX_CONTACTS):
+    """
+    Moves circles by shift, stopping each of them at its first contact with a rectangle during the step, reflecting
+    its velocity and the rest of its shift, and continuing. A circle bounces at most max_contacts times per step;
+    if it still has some way to go after that, it stays at its last contact point. coords and vel are changed in
+    place.
+
+    :param pair_ball: indices of the circles of the (circle, rectangle) pairs, which can touch.
+    :param pair_wall: indices of the rectangles of the pairs.
+    :param rects: (centres, normals, parallels, half_widths, half_lengths) of the rectangles, see sweep_circle_rect.
+    """
+    n = len(coords)
+    centres, normals, parallels, half_widths, half_lengths = rects
+    shift = shift.copy()
+    moving = np.ones(n, dtype=bool)
+    for contact in range(max_contacts):
+        best_toi = np.full(n, np.inf)
+        best_normal = np.zeros((n, 2))
+        best_depth = np.zeros(n)
+        active = moving[pair_ball]
+        pair_ball = pair_ball[active]
+        pair_wall = pair_wall[active]
+        if len(pair_ball):
+            w = pair_wall
+            toi, normal, depth = sweep_circle_rect(coords[pair_ball], shift[pair_ball], rad[pair_ball],
+                                                   centres[w], normals[w], parallels[w],
+                                                   half_widths[w], half_lengths[w])
+            # The earliest contact of every circle; ties go to the rectangle, which comes first in the list.
+            found = np.flatnonzero(np.isfinite(toi))
+            found = found[np.lexsort((toi[found], pair_ball[found]))]
+            balls = pair_ball[found]
+            first = found[np.r_[True, balls[1:] != balls[:-1]]] if len(found) else found
+            best_toi[pair_ball[first]] = toi[first]
+            best_normal[pair_ball[first]] = normal[first]
+            best_depth[pair_ball[first]] = depth[first]
+
+        hit = np.isfinite(best_toi)
+        free = moving & ~hit
+        coords[free] += shift[free]
+        moving &= hit
+        if not moving.any():
+            break
+
+        h = np.flatnonzero(moving)
+        toi = best_toi[h][:, None]
+        normal = best_normal[h]
+        coords[h] += shift[h] * toi + normal * (best_depth[h] + CONTACT_GAP)[:, None]
+        rest = shift[h] * (1 - toi)
+        rest -= 2 * np.minimum(np.sum(rest * normal, axis=1), 0)[:, None] * normal
+        shift[h] = rest
+        vel[h] -= 2 * np.minimum(np.sum(vel[h] * normal, axis=1), 0)[:, None] * normal
+
+
+def wall_rects(walls):
+    """
+    Returns the rectangles of the walls in the form sweep_pairs takes them. They only change with the level, so
+    they are built once for it.
+    """
+    return (np.array([wall.coords for wall in walls], dtype=float).reshape(-1, 2),
+            np.array([wall.normal for wall in walls], dtype=float).reshape(-1, 2),
+            np.array([wall.parallel for wall in walls], dtype=float).reshape(-1, 2),
+            np.array([wall.half_width for wall in walls], dtype=float),
+            np.array([wall.half_length for wall in walls], dtype=float))
 
 
-class Ball:
+def random_color(rng=random):
     """
-    Creates balls, manages their movement, collisions, rendering.
+    Returns a random color. rng is the random number generator to take it from.
     """
-    def __init__(self, coords, vel, rad=15, color=None):
+    return rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255)
+
+
+class SpriteCache:
+    """
+    Keeps pre-rendered surfaces of circles and polygons, so that they are rasterized once and then only blitted.
+    The cache is bounded: when it is full, the least recently used sprite is dropped.
+    """
+    def __init__(self, max_size=512):
+        self.max_size = max_size
+        self.sprites = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bypassed = 0
+
+    def get(self, key, make):
+        """
+        Returns the sprite for key. If it is not in the cache, it is created by calling make(), converted to the
+        pixel format of the display and stored.
         """
-        Creates a ball with given initial conditions.
+        sprite = self.sprites.get(key)
+        if sprite is not None:
+            self.hits += 1
+            self.sprites.move_to_end(key)
+            return sprite
+        self.misses += 1
+        sprite = make()
+        if pg.display.get_surface() is not None:
+            key_color = sprite.get_colorkey()
+            sprite = sprite.convert()
+            sprite.set_colorkey(key_color, pg.RLEACCEL)
+        self.sprites[key] = sprite
+        if len(self.sprites) > self.max_size:
+            self.sprites.popitem(last=False)
+            self.evictions += 1
+        return sprite
+
+    @staticmethod
+    def _blank(size, color):
+        key_color = (1, 2, 3) if tuple(color) != (1, 2, 3) else (3, 2, 1)
+        surface = pg.Surface(size)
+        surface.fill(key_color)
+        surface.set_colorkey(key_color)
+        return surface
+
+    def circle(self, rad, color):
+        """
+        Returns a sprite of a circle of radius rad. Its centre is at (rad, rad).
+        """
+        def make():
+            surface = self._blank((2 * rad + 1, 2 * rad + 1), color)
+            pg.draw.circle(surface, color, (rad, rad), rad)
+            return surface
+        return self.get(("circle", rad, color), make)
+
+    def circles(self, screen, corners, rad, colors):
+        """
+        Draws circles with the given top left corners, radii and colors. Returns the list of their bounding
+        rectangles.
+
+        Sprites of the circles are blitted if they fit into half of the cache, the rest of which is left to the
+        other sprites. Otherwise the circles of a frame would evict each other before being drawn again, and every
+        one of them would be rasterized into a new sprite, so they are drawn with pg.draw.circle instead.
+
+        :param corners: (n, 2) integer array.
+        :param rad: integer array of length n.
+        :param colors: (n, 3) uint8 array.
+        """
+        keys = rad.astype(np.int64) << 24 | colors.astype(np.int64) @ np.array([1 << 16, 1 << 8, 1])
+        corners = corners.tolist()
+        rad = rad.tolist()
+        colors = list(map(tuple, colors.tolist()))
+        if len(np.unique(keys)) <= self.max_size // 2:
+            return screen.blits([(self.circle(r, c), corner) for r, c, corner in zip(rad, colors, corners)])
+        self.bypassed += len(rad)
+        return [pg.draw.circle(screen, c, (x + r, y + r), r) for r, c, (x, y) in zip(rad, colors, corners)]
+
+    def polygon(self, vertexes, color):
+        """
+        Returns a sprite of a polygon and the position of its top left corner on the screen.
+        """
+        vertexes = np.asarray(vertexes, dtype=int)
+        corner = vertexes.min(axis=0)
+        local = tuple(map(tuple, (vertexes - corner).tolist()))
+
+        def make():
+            surface = self._blank(tuple(np.max(local, axis=0) + 1), color)
+            pg.draw.polygon(surface, color, local)
+            return surface
+        return self.get(("polygon", local, color), make), tuple(corner.tolist())
+
+
+sprites = SpriteCache()
+
+
+class BallArray:
+    """
+    Stores all the balls in contiguous arrays and moves, bounces and culls them with vectorized operations.
+    The arrays work as a pool: slots of dead balls are reused by new ones, so shooting and despawning do not
+    allocate anything once the pool is big enough.
+    """
+    def __init__(self, capacity=64):
+        """
+        Creates an empty container with room for capacity balls. It grows automatically when it is full.
+
+        spawned - number of balls ever added.
+        reused - number of balls added to a slot, which had been used by a dead ball.
+        despawned - number of dead balls removed.
+        grown - number of times the pool had to grow.
+        """
+        self.size = 0
+        self.high_water = 0
+        self.spawned = 0
+        self.reused = 0
+        self.despawned = 0
+        self.grown = 0
+        self.coords = np.zeros((capacity, 2), dtype=float)
+        self.prev_coords = np.zeros((capacity, 2), dtype=float)
+        self.vel = np.zeros((capacity, 2), dtype=float)
+        self.rad = np.zeros(capacity, dtype=int)
+        self.color = np.zeros((capacity, 3), dtype=np.uint8)
+        self.alive = np.zeros(capacity, dtype=bool)
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def capacity(self):
+        return len(self.alive)
+
+    def pool_stats(self):
+        """
+        Returns a dictionary with the size of the pool and the reuse counters.
+        """
+        return {"size": self.size, "capacity": self.capacity, "spawned": self.spawned, "reused": self.reused,
+                "despawned": self.despawned, "grown": self.grown}
+
+    def _fields(self):
+        return ["coords", "prev_coords", "vel", "rad", "color", "alive"]
+
+    def _grow(self):
+        """
+        Doubles the capacity of the container.
+        """
+        for name in self._fields():
+            old = getattr(self, name)
+            new = np.zeros((2 * len(old),) + old.shape[1:], dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+        self.grown += 1
+
+    def add(self, coords, vel, rad=15, color=None):
+        """
+        Adds a ball with given initial conditions. Returns its index.
         """
         if color is None:
-            color = (randint(0, 255), randint(0, 255), randint(0, 255))
-        self.color = color
-        self.coords = np.array(coords, dtype=int)
-        self.vel = np.array(vel, dtype=float)
-        self.rad = rad
-        self.is_alive = True
+            color = random_color()
+        if self.size == len(self.alive):
+            self._grow()
+        i = self.size
+        if i < self.high_water:
+            self.reused += 1
+        else:
+            self.high_water = i + 1
+        self.spawned += 1
+        self.coords[i] = coords
+        self.prev_coords[i] = coords
+        self.vel[i] = vel
+        self.rad[i] = rad
+        self.color[i] = color
+        self.alive[i] = True
+        self.size += 1
+        return i
 
-    def draw(self, screen):
+    def add_many(self, coords, vel, rad=15, color=BLACK):
         """
-        Draws the ball on the screen.
+        Adds many balls at once. coords, vel, rad and color are broadcast against each other.
+        Returns the indices of the new balls.
         """
-        pg.draw.circle(screen, self.color, self.coords, self.rad)
+        k = len(vel)
+        while self.size + k > self.capacity:
+            self._grow()
+        new = slice(self.size, self.size + k)
+        self.reused += max(0, min(self.high_water, self.size + k) - self.size)
+        self.high_water = max(self.high_water, self.size + k)
+        self.spawned += k
+        self.coords[new] = coords
+        self.prev_coords[new] = coords
+        self.vel[new] = vel
+        self.rad[new] = rad
+        self.color[new] = color
+        self.alive[new] = True
+        self.size += k
+        return np.arange(new.start, new.stop)
 
-    def move(self, t_step=TIME_STEP, g=1.):
+    def draw(self, screen, alpha=1., scale=1.):
         """
-        Moves the ball. Velocity of the ball is also changed due to gravity.
+        Draws all the balls on the screen. Returns the list of their bounding rectangles.
+
+        :param alpha: the balls are drawn between the positions they had before the last physics tick (alpha = 0)
+         and their current positions (alpha = 1).
+        :param scale: coordinates and sizes are multiplied by scale, when the screen is smaller than the field.
+        """
+        n = self.size
+        coords = self.coords[:n]
+        if alpha != 1.:
+            coords = self.prev_coords[:n] + (coords - self.prev_coords[:n]) * alpha
+        rad = self.rad[:n]
+        if scale != 1.:
+            coords = coords * scale
+            rad = np.maximum(np.rint(rad * scale).astype(int), 1)
+        return sprites.circles(screen, np.rint(coords).astype(int) - rad[:, None], rad, self.color[:n])
+
+    def copy(self):
+        """
+        Returns a new BallArray with copies of the balls, without the free slots and the counters.
+        """
+        n = self.size
+        balls = BallArray(capacity=max(n, 1))
+        for name in self._fields():
+            getattr(balls, name)[:n] = getattr(self, name)[:n]
+        balls.size = n
+        return balls
+
+    def save_positions(self):
         """
-        self.vel[1] += g * t_step
-        self.coords += (self.vel * t_step).astype(int)
+        Remembers the current positions of the balls as the positions before the next physics tick.
+        """
+        self.prev_coords[:self.size] = self.coords[:self.size]
+
+    def move(self, t_step=TIME_STEP, g=1., walls=(), grid=None, rects=None):
+        """
+        Moves all the balls. Velocity of the balls is also changed due to gravity. Balls, whose paths cross the
+        walls, bounce off them at the moment of impact. Balls, which have almost stopped on the floor, die.
+
+        :param walls: walls the balls can hit.
+        :param grid: BallGrid used to find the balls near each wall. Every ball is checked if it is None.
+        :param rects: wall_rects(walls), if it has been built already.
+        """
+        n = self.size
+        vel = self.vel[:n]
+        coords = self.coords[:n]
+        vel[:, 1] += g * t_step
+        if len(walls) > 0:
+            self.sweep(vel * t_step, walls, grid, rects)
+        else:
+            coords += vel * t_step
         self.check_walls()
-        if np.linalg.norm(self.vel) < 1 and\
-                self.coords[1] > SCREEN_SIZE[1] - 2 * self.rad:
-            self.is_alive = False
+        stopped = (np.hypot(vel[:, 0], vel[:, 1]) < 1) & (coords[:, 1] > SCREEN_SIZE[1] - 2 * self.rad[:n])
+        self.alive[:n] &= ~stopped
+
+    def sweep(self, shift, walls, grid=None, rects=None, max_contacts=MAX_CONTACTS):
+        """
+        Moves the balls by shift, bouncing them off the walls. See sweep_pairs.
+
+        :param rects: wall_rects(walls). It is built here if it is None.
+        """
+        n = self.size
+        coords = self.coords[:n]
+        vel = self.vel[:n]
+        rad = self.rad[:n]
+
+        reach = float(np.hypot(shift[:, 0], shift[:, 1]).max()) if n else 0.
+        if grid is not None:
+            grid.rebuild(self)
+            grid.all_pairs += len(walls) * n
+            candidates = [grid.query(self, wall.box[0] - reach, wall.box[1] - reach,
+                                     wall.box[2] + reach, wall.box[3] + reach) for wall in walls]
+        else:
+            candidates = [np.arange(n)] * len(walls)
+        pair_ball = np.concatenate(candidates) if walls else np.zeros(0, dtype=int)
+        pair_wall = np.repeat(np.arange(len(walls)), [len(idx) for idx in candidates])
+        if rects is None:
+            rects = wall_rects(walls)
+        sweep_pairs(coords, vel, rad, shift, pair_ball, pair_wall, rects, max_contacts)
 
     def check_walls(self):
         """
-        Checks if the ball has collided with walls and calls flip_vel method to change its velocity if it did.
+        Bounces all the balls, which have reached the edges of the screen.
         """
-        n = [[1, 0], [0, 1]]
+        n = self.size
+        coords = self.coords[:n]
+        rad = self.rad[:n]
         for i in range(2):
-            if self.coords[i] < self.rad:
-                self.coords[i] = self.rad
-                self.flip_vel(n[i])
-            elif self.coords[i] > SCREEN_SIZE[i] - self.rad:
-                self.coords[i] = SCREEN_SIZE[i] - self.rad
-                self.flip_vel(n[i])
+            low = coords[:, i] < rad
+            high = coords[:, i] > SCREEN_SIZE[i] - rad
+            coords[low, i] = rad[low]
+            coords[high, i] = SCREEN_SIZE[i] - rad[high]
+            self.flip_vel(low | high, i)
+
+    def flip_vel(self, mask, axis, coef_perp=0.8, coef_par=0.9):
+        """
+        Changes the velocity of the balls selected by mask as if they collided inelastically with a wall, whose
+        normal is the coordinate axis "axis".
+        """
+        vel = self.vel[:self.size]
+        vel[mask, axis] *= -coef_perp
+        vel[mask, 1 - axis] *= coef_par
+
+    def cull(self):
+        """
+        Removes dead balls, keeping the alive ones contiguous and in order.
 
-    def flip_vel(self, axis, coef_perp=0.8, coef_par=0.9):
+        :return: boolean mask of the balls, which were kept, or None if no ball was removed.
         """
-        Changes the velocity of the ball as if it collided inelastically with a wall with normal vector "axis".
+        n = self.size
+        keep = self.alive[:n].copy()
+        m = int(np.count_nonzero(keep))
+        if m == n:
+            return None
+        for name in self._fields():
+            arr = getattr(self, name)
+            arr[:m] = arr[:n][keep]
+        self.alive[m:n] = False
+        self.despawned += n - m
+        self.size = m
+        return keep
+
+
+class SweepAndPrune:
+    """
+    Broad phase for collisions between balls. The balls are kept sorted by the left ends of their x intervals; only
+    balls, whose x intervals overlap, can touch. Balls move little between ticks, so the order of the previous tick
+    is almost right, and sorting it again takes nearly linear time.
+    """
+    def __init__(self):
+        """
+        candidate_pairs - number of pairs with overlapping x intervals in the last call of pairs.
+        """
+        self.order = np.zeros(0, dtype=int)
+        self.candidate_pairs = 0
+
+    def remove(self, keep):
+        """
+        Updates the order after BallArray.cull removed the balls, which are not in the mask keep.
+        """
+        new_index = np.cumsum(keep) - 1
+        order = self.order[self.order < len(keep)]
+        self.order = new_index[order[keep[order]]]
+
+    def pairs(self, balls):
+        """
+        Returns two arrays of indices (a, b) of the pairs of balls, whose bounding boxes overlap.
         """
-        axis = np.array(axis)
-        axis = axis / np.linalg.norm(axis)
-        vel_perp = self.vel.dot(axis) * axis
-        vel_par = self.vel - vel_perp
-        self.vel = -vel_perp * coef_perp + vel_par * coef_par
+        n = len(balls)
+        order = self.order
+        if len(order) < n:
+            order = np.concatenate([order, np.arange(len(order), n)])
+        elif len(order) > n:
+            order = np.arange(n)
+        x = balls.coords[:n, 0]
+        y = balls.coords[:n, 1]
+        rad = balls.rad[:n]
+        left = x - rad
+        order = order[np.argsort(left[order], kind="stable")]
+        self.order = order
+
+        left = left[order]
+        right = (x + rad)[order]
+        ends = np.searchsorted(left, right, side="right")
+        counts = ends - np.arange(n) - 1
+        total = int(counts.sum())
+        self.candidate_pairs = total
+        first = np.repeat(np.arange(n), counts)
+        second = first + 1 + np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        a = order[first]
+        b = order[second]
+        close = np.abs(y[a] - y[b]) <= rad[a] + rad[b]
+        return a[close], b[close]
+
+
+def collide_balls(balls, a, b, coef_perp=0.8, coef_par=0.9):
+    """
+    Implements inelastic collisions between the pairs of balls (a[i], b[i]), all at once. The relative velocity of
+    two touching balls is changed the way BallArray.flip_vel changes the velocity of a ball hitting a wall; masses are
+    proportional to the areas of the balls. Overlapping balls are pushed apart.
+
+    :return: number of pairs, which touch.
+    """
+    coords = balls.coords
+    vel = balls.vel
+    delta = coords[a] - coords[b]
+    dist = np.hypot(delta[:, 0], delta[:, 1])
+    reach = balls.rad[a] + balls.rad[b]
+    touching = (dist < reach) & (dist > 0)
+    a = a[touching]
+    b = b[touching]
+    if len(a) == 0:
+        return 0
+    normal = delta[touching] / dist[touching][:, None]
+    overlap = (reach[touching] - dist[touching])[:, None]
+    mass_a = balls.rad[a].astype(float) ** 2
+    mass_b = balls.rad[b].astype(float) ** 2
+    share_a = (mass_b / (mass_a + mass_b))[:, None]
+    share_b = (mass_a / (mass_a + mass_b))[:, None]
+
+    np.add.at(coords, a, normal * overlap * share_a)
+    np.subtract.at(coords, b, normal * overlap * share_b)
+
+    rel = vel[a] - vel[b]
+    rel_perp = np.sum(rel * normal, axis=1)[:, None]
+    approaching = rel_perp[:, 0] < 0
+    change = (-rel_perp * normal * coef_perp + (rel - rel_perp * normal) * coef_par) - rel
+    change[~approaching] = 0
+    np.add.at(vel, a, change * share_a)
+    np.subtract.at(vel, b, change * share_b)
+    return len(a)
+
+
+class BallGrid:
+    """
+    Uniform grid over the centres of the balls, rebuilt every frame. Used as a broad phase for collisions:
+    targets and walls ask the grid for the balls in nearby cells instead of checking every ball.
+    """
+    def __init__(self, cell_size=50):
+        """
+        Creates an empty grid.
+
+        candidate_pairs - number of (object, ball) pairs found in nearby cells since the counters were reset.
+        narrow_tests - number of those pairs, whose bounding boxes overlap and which go to the exact test.
+        all_pairs - number of pairs a brute force check would have tested.
+        """
+        self.cell_size = cell_size
+        self.n_cols = SCREEN_SIZE[0] // cell_size + 1
+        self.n_rows = SCREEN_SIZE[1] // cell_size + 1
+        self.order = np.zeros(0, dtype=int)
+        self.keys = np.zeros(0, dtype=int)
+        self.max_rad = 0
+        self.candidate_pairs = 0
+        self.narrow_tests = 0
+        self.all_pairs = 0
+
+    def rebuild(self, balls):
+        """
+        Sorts the balls by the cell their centres are in.
+        """
+        n = len(balls)
+        cells = (balls.coords[:n] // self.cell_size).astype(int)
+        cols = np.clip(cells[:, 0], 0, self.n_cols - 1)
+        rows = np.clip(cells[:, 1], 0, self.n_rows - 1)
+        keys = cols * self.n_rows + rows
+        self.order = np.argsort(keys, kind="stable")
+        self.keys = keys[self.order]
+        self.max_rad = int(balls.rad[:n].max()) if n else 0
+
+    def reset_counters(self):
+        """
+        Sets the counters of pairs to zero.
+        """
+        self.candidate_pairs = 0
+        self.narrow_tests = 0
+        self.all_pairs = 0
+
+    def query(self, balls, x_min, y_min, x_max, y_max):
+        """
+        Returns indices of the balls, which may touch the box [x_min, x_max] x [y_min, y_max].
+        """
+        cs = self.cell_size
+        col_0 = min(max(int(x_min - self.max_rad) // cs, 0), self.n_cols - 1)
+        col_1 = min(max(int(x_max + self.max_rad) // cs, 0), self.n_cols - 1)
+        row_0 = min(max(int(y_min - self.max_rad) // cs, 0), self.n_rows - 1)
+        row_1 = min(max(int(y_max + self.max_rad) // cs, 0), self.n_rows - 1)
+        parts = []
+        for col in range(col_0, col_1 + 1):
+            lo = np.searchsorted(self.keys, col * self.n_rows + row_0, side="left")
+            hi = np.searchsorted(self.keys, col * self.n_rows + row_1, side="right")
+            if hi > lo:
+                parts.append(self.order[lo:hi])
+        if not parts:
+            return np.zeros(0, dtype=int)
+        idx = np.concatenate(parts)
+        self.candidate_pairs += len(idx)
+
+        coords = balls.coords[idx]
+        rad = balls.rad[idx]
+        close = (coords[:, 0] + rad >= x_min) & (coords[:, 0] - rad <= x_max) & \
+                (coords[:, 1] + rad >= y_min) & (coords[:, 1] - rad <= y_max)
+        idx = idx[close]
+        self.narrow_tests += len(idx)
+        return idx
 
 
 class Target:
@@ -77,24 +687,34 @@ class Target:
         Creates a target with given initial conditions.
         """
         if color is None:
-            color = (randint(0, 255), randint(0, 255), randint(0, 255))
+            color = random_color()
         self.color = color
         self.coord = coord
         self.rad = rad
         self.is_alive = True
 
-    def draw(self, screen):
+    def draw(self, screen, scale=1.):
         """
-        Draws the target on the screen.
+        Draws the target on the screen, with coordinates and sizes multiplied by scale.
         """
-        pg.draw.circle(screen, self.color, self.coord, self.rad)
+        if scale != 1.:
+            rad = max(round(self.rad * scale), 1)
+            return screen.blit(sprites.circle(rad, tuple(self.color)),
+                               (round(self.coord[0] * scale) - rad, round(self.coord[1] * scale) - rad))
+        return screen.blit(sprites.circle(self.rad, tuple(self.color)),
+                           (self.coord[0] - self.rad, self.coord[1] - self.rad))
 
-    def check_collision(self, ball):
+    def check_collisions(self, balls, idx=None):
         """
-        Checks if the ball collided with the target.
+        Checks which balls of a BallArray collided with the target. Returns a boolean mask.
+
+        :param balls: BallArray with the balls.
+        :param idx: indices of the balls to check. All the balls are checked by default.
         """
-        distance = (sum((ball.coords[i] - self.coord[i]) ** 2 for i in range(2))) ** 0.5
-        return distance <= self.rad + ball.rad
+        if idx is None:
+            idx = slice(0, len(balls))
+        delta = balls.coords[idx] - self.coord
+        return np.hypot(delta[:, 0], delta[:, 1]) <= self.rad + balls.rad[idx]
 
 
 class Gun:
@@ -114,9 +734,9 @@ class Gun:
         self.power = min_pow
         self.active = False
 
-    def draw(self, screen):
+    def draw(self, screen, scale=1.):
         """
-        Draws a gun on the screen.
+        Draws a gun on the screen, with coordinates and sizes multiplied by scale.
         """
         end_pos = np.array([self.coords[0] + self.power * np.cos(self.angle),
                             self.coords[1] + self.power * np.sin(self.angle)], dtype=int)
@@ -126,18 +746,45 @@ class Gun:
 
         vertexes = [self.coords + normal, self.coords - normal,
                     self.coords - normal + parallel, self.coords + normal + parallel]
+        if scale != 1.:
+            vertexes = [vertex * scale for vertex in vertexes]
 
-        pg.draw.polygon(screen, RED, vertexes)
+        return pg.draw.polygon(screen, RED, vertexes)
 
-    def shoot(self):
+    def shoot(self, balls, color=None):
         """
-        Creates a ball. Velocity of the ball depends on where the gun is pointing and how much power it has.
+        Adds a ball to the BallArray balls. Velocity of the ball depends on where the gun is pointing and how much
+        power it has. Returns the index of the new ball.
         """
-        vel = [int(self.power * np.cos(self.angle)),
-               int(self.power * np.sin(self.angle))]
+        vel = (int(self.power * math.cos(self.angle)),
+               int(self.power * math.sin(self.angle)))
         self.active = False
         self.power = self.min_pow
-        return Ball(list(self.coords), vel)
+        return balls.add(self.coords, vel, color=color)
+
+    def shoot_barrage(self, balls, colors, spread=0.3, rad=15):
+        """
+        Shoots a fan of len(colors) balls, spread over the angle spread around the direction of the gun. The balls
+        start one after another along their directions, so that they do not overlap. Returns their indices.
+        """
+        count = len(colors)
+        angles = self.angle + np.linspace(-spread / 2, spread / 2, count)
+        direction = np.stack([np.cos(angles), np.sin(angles)], axis=1)
+        vel = np.trunc(self.power * direction)
+        coords = self.coords + direction * (2 * rad + 1) * np.arange(count)[:, None]
+        self.active = False
+        self.power = self.min_pow
+        return balls.add_many(coords, vel, rad=rad, color=np.array(colors))
+
+    def copy(self):
+        """
+        Returns a gun in the same state.
+        """
+        gun = Gun(self.coords.copy(), self.min_pow, self.max_pow)
+        gun.angle = self.angle
+        gun.power = self.power
+        gun.active = self.active
+        return gun
 
     def gain_power(self):
         """
@@ -154,6 +801,197 @@ class Gun:
                                 mouse_pos[0] - self.coords[0])
 
 
+class PreviewPath:
+    """
+    Predicted path of one shell. It is computed chunk by chunk, so a long path can be spread over several frames.
+    """
+    def __init__(self, coords, vel, rad):
+        self.coords = np.array(coords, dtype=float)
+        self.vel = np.array(vel, dtype=float)
+        self.rad = rad
+        self.points = [tuple(int(c) for c in coords)]
+        self.steps = 0
+        self.done = False
+
+    def extend(self, walls, max_steps, chunk, t_step=TIME_STEP, g=1.):
+        """
+        Computes up to chunk more steps of the path. Between bounces the shell flies along a parabola, so all the
+        positions of a chunk are found at once; the first step, which touches a wall or an edge of the screen, is
+        made with the game physics.
+        """
+        n = min(chunk, max_steps - self.steps)
+        k = np.arange(1, n + 1)
+        pos = self.coords + t_step * k[:, None] * self.vel
+        pos[:, 1] += g * t_step ** 2 * k * (k + 1) / 2
+        prev = np.vstack([self.coords, pos[:-1]])
+
+        first_hit = n
+        rad = np.full(n, self.rad)
+        for wall in walls:
+            hits = np.flatnonzero(np.isfinite(wall.sweep(prev, pos - prev, rad)[0]))
+            if len(hits):
+                first_hit = min(first_hit, hits[0])
+        out = np.flatnonzero(((pos < self.rad) | (pos > np.array(SCREEN_SIZE) - self.rad)).any(axis=1))
+        if len(out):
+            first_hit = min(first_hit, out[0])
+
+        if first_hit > 0:
+            self.points.extend(map(tuple, np.rint(pos[:first_hit]).astype(int).tolist()))
+            self.coords = pos[first_hit - 1]
+            self.vel[1] += g * t_step * first_hit
+        self.steps += first_hit
+        if first_hit < n:
+            ball = BallArray(capacity=1)
+            ball.add(self.coords, self.vel, rad=self.rad, color=BLACK)
+            ball.move(t_step, g, walls=walls)
+            self.coords = ball.coords[0].copy()
+            self.vel = ball.vel[0].copy()
+            self.points.append(tuple(np.rint(self.coords).astype(int).tolist()))
+            self.steps += 1
+            self.done = not ball.alive[0]
+        if self.steps >= max_steps:
+            self.done = True
+
+
+class TrajectoryPreview:
+    """
+    Shows where the next shell will fly while the player is aiming. Paths are cached by the angle bucket, the power,
+    the position of the gun and the layout of the walls; the cache is cleared when a new level is generated.
+    """
+    def __init__(self, steps=90, chunk=16, chunks_per_frame=2, angle_bucket=np.pi / 360, max_paths=256, rad=15):
+        """
+        :param steps: number of physics steps the path is predicted for.
+        :param chunk: number of steps computed at once.
+        :param chunks_per_frame: number of chunks a path is extended by in one frame.
+        :param angle_bucket: angles of the gun are rounded to multiples of angle_bucket.
+        :param max_paths: size of the cache. The least recently used paths are dropped.
+        :param rad: radius of the shells.
+        """
+        self.steps = steps
+        self.chunk = chunk
+        self.chunks_per_frame = chunks_per_frame
+        self.angle_bucket = angle_bucket
+        self.max_paths = max_paths
+        self.rad = rad
+        self.paths = OrderedDict()
+        self.aims = {}
+        self.layout = 0
+
+    def invalidate(self):
+        """
+        Forgets all the paths. Called when the walls change.
+        """
+        self.paths.clear()
+        self.aims.clear()
+        self.layout += 1
+
+    def _start(self, aim, gun):
+        """
+        Creates the path for the aim and the power of the gun and puts it into the cache.
+        """
+        angle = aim[0] * self.angle_bucket
+        vel = (int(gun.power * math.cos(angle)), int(gun.power * math.sin(angle)))
+        path = PreviewPath(gun.coords, vel, self.rad)
+        self.paths[aim, gun.power] = path
+        self.aims.setdefault(aim, {})[gun.power] = path
+        if len(self.paths) > self.max_paths:
+            (old_aim, old_power), old = self.paths.popitem(last=False)
+            del self.aims[old_aim][old_power]
+            if not self.aims[old_aim]:
+                del self.aims[old_aim]
+        return path
+
+    def path(self, gun, walls):
+        """
+        Returns the list of points of the predicted path of a shell shot by the gun now.
+
+        While the gun is charged, its power changes every frame, and a path would never get longer than the steps
+        of one frame. So if the path for the power has not been started, the unfinished path of the nearest power
+        for the same aim is computed first. Until the path for the power is finished, the finished path of the
+        nearest power is shown.
+        """
+        bucket = round(gun.angle / self.angle_bucket)
+        aim = (bucket, int(gun.coords[0]), int(gun.coords[1]), self.layout)
+        path = self.paths.get((aim, gun.power))
+        if path is not None and path.done:
+            self.paths.move_to_end((aim, gun.power))
+            return path.points
+        powers = self.aims.get(aim, {})
+        finished = [power for power, other in powers.items() if other.done]
+        shown = powers[min(finished, key=lambda power: abs(power - gun.power))] if finished else None
+        if path is not None:
+            self.paths.move_to_end((aim, gun.power))
+        else:
+            unfinished = [power for power, other in powers.items() if not other.done]
+            if unfinished:
+                path = powers[min(unfinished, key=lambda power: abs(power - gun.power))]
+            else:
+                path = self._start(aim, gun)
+        if shown is None:
+            shown = path
+        for i in range(self.chunks_per_frame):
+            if path.done:
+                break
+            path.extend(walls, self.steps, self.chunk)
+        return shown.points
+
+    def draw(self, screen, gun, walls, scale=1.):
+        """
+        Draws the predicted path, with coordinates multiplied by scale. Returns its bounding rectangle, or None if
+        there is nothing to draw.
+        """
+        points = self.path(gun, walls)
+        if len(points) < 2:
+            return None
+        if scale != 1.:
+            points = [(x * scale, y * scale) for x, y in points]
+        return pg.draw.lines(screen, GREY, False, points)
+
+
+_fonts = {}
+
+
+def get_font(name, size):
+    """
+    Returns a system font. Each font is looked up only the first time it is asked for.
+    """
+    key = (name, size)
+    if key not in _fonts:
+        if not _fonts:
+            # Fonts die with pygame.quit(); forget them then, so that the next game loads them again.
+            pg.register_quit(_fonts.clear)
+        _fonts[key] = pg.font.SysFont(name, size)
+    return _fonts[key]
+
+
+class Label:
+    """
+    Text of the form prefix + value. It is rendered again only when the value changes.
+    """
+    def __init__(self, prefix, font_name='Comic Sans MS', size=30, color=(200, 200, 200)):
+        self.prefix = prefix
+        self.font_name = font_name
+        self.size = size
+        self.color = color
+        self.value = None
+        self.surface = None
+
+    def render(self, value):
+        """
+        Returns the surface with the text for the value.
+        """
+        if self.surface is None or value != self.value:
+            self.value = value
+            self.surface = get_font(self.font_name, self.size).render(self.prefix + str(value), False, self.color)
+        return self.surface
+
+    def draw(self, screen, value, pos):
+        """
+        Draws the text for the value on the screen at pos. Returns the rectangle of the text.
+        """
+        return screen.blit(self.render(value), pos)
+
+
 class ScoreTable:
     """
     Manages counting of points and showing them to th player.
@@ -161,22 +999,28 @@ class ScoreTable:
     def __init__(self, targets_hit=0, balls_used=0):
         self.targets_hit = targets_hit
         self.balls_used = balls_used
-        self.score = max(0, self.targets_hit - self.balls_used)
+        self.labels = [Label("Targets hit: "), Label("Balls used: "), Label("Score ")]
 
-    def draw(self, screen):
-        self.score = max(0, self.targets_hit - self.balls_used)
+    @property
+    def score(self):
+        """
+        Score of the player. It is kept up to date without drawing the table, so headless games use it too.
+        """
+        return max(0, self.targets_hit - self.balls_used)
 
-        font = pg.font.SysFont('Comic Sans MS', 30)
+    def changed(self):
+        """
+        Checks if the table shows other numbers than it showed when it was drawn last time.
+        """
+        values = [self.targets_hit, self.balls_used, self.score]
+        return any(label.surface is None or label.value != value for label, value in zip(self.labels, values))
 
-        text_targets_hit = font.render("Targets hit: " + str(self.targets_hit),
-                                       False, (200, 200, 200))
-        text_balls_used = font.render("Balls used: " + str(self.balls_used),
-                                      False, (200, 200, 200))
-        text_score = font.render("Score " + str(self.score),
-                                 False, (200, 200, 200))
-        screen.blit(text_targets_hit, (0, 0))
-        screen.blit(text_balls_used, (0, 50))
-        screen.blit(text_score, (0, 100))
+    def draw(self, screen):
+        """
+        Draws the table. Returns the list of rectangles of the text.
+        """
+        values = [self.targets_hit, self.balls_used, self.score]
+        return [label.draw(screen, value, (0, 50 * i)) for i, (label, value) in enumerate(zip(self.labels, values))]
 
 
 class Wall:
@@ -203,142 +1047,738 @@ class Wall:
                                   self.coords - self.width * self.normal / 2 - self.length * self.parallel / 2,
                                   self.coords + self.width * self.normal / 2 - self.length * self.parallel / 2],
                                  dtype=int)
+        self.box = (*self.vertexes.min(axis=0), *self.vertexes.max(axis=0))
+        self.half_width = self.width / 2
+        self.half_length = self.length / 2
 
         if color is None:
             self.color = YELLOW
 
-    def draw(self, screen):
+    def draw(self, screen, scale=1.):
+        """
+        Draws the wall on the screen, with coordinates and sizes multiplied by scale.
+        """
+        vertexes = self.vertexes
+        if scale != 1.:
+            vertexes = np.rint(vertexes * scale).astype(int)
+        sprite, corner = sprites.polygon(vertexes, self.color)
+        return screen.blit(sprite, corner)
+
+    def sweep(self, start, shift, rad):
+        """
+        Finds when balls moving from start by shift first touch the wall. See sweep_circle_rect.
+        """
+        return sweep_circle_rect(start, shift, rad, self.coords, self.normal, self.parallel,
+                                 self.half_width, self.half_length)
+
+
+class LevelGenerator:
+    """
+    Generates levels. Targets and walls are put at the points of a Poisson-disk sample of the screen, which are
+    never closer to each other than spacing, so they do not overlap whatever the angles of the walls are. The
+    sample is built with Bridson's algorithm on a grid of cells, which hold at most one point each, so it takes
+    time proportional to the number of points. Levels are generated from their own seeds and cached, so a level
+    can be made again at once.
+    """
+    def __init__(self, spacing=None, tries=30, max_levels=64, wall_length=100, wall_width=25, ball_rad=15):
+        """
+        :param spacing: smallest distance between the centres of two objects. By default a ball fits between any
+         two walls. It is decreased for levels with many walls, until the walls could touch.
+        :param tries: number of candidate points tried around a point before it is given up.
+        :param max_levels: size of the cache. The least recently used levels are dropped.
+        :param wall_length: length of the walls.
+        :param wall_width: width of the walls.
+        :param ball_rad: radius of the balls.
+        """
+        reach = math.hypot(wall_length / 2, wall_width / 2)
+        if spacing is None:
+            spacing = 2 * reach + 2 * ball_rad
+        self.spacing = spacing
+        self.min_spacing = min(spacing, 2 * reach)
+        self.tries = tries
+        self.max_levels = max_levels
+        self.wall_length = wall_length
+        self.wall_width = wall_width
+        self.area = (100, reach, SCREEN_SIZE[0] - reach, SCREEN_SIZE[1] - reach)
+        self.levels = OrderedDict()
+
+    def sample(self, rng, count=0):
+        """
+        Returns a list of points of the area, no two of which are closer than spacing. If fewer than count points
+        fit, the spacing is decreased as much as the density of the sample says it should be, down to min_spacing,
+        and the gaps between the points already placed are filled at the smaller spacing.
+        """
+        x_min, y_min, x_max, y_max = self.area
+        # The cells are small enough for the smallest spacing, so a cell never holds more than one point.
+        cell = self.min_spacing / math.sqrt(2)
+        cols = int((x_max - x_min) / cell) + 1
+        rows = int((y_max - y_min) / cell) + 1
+        grid = [-1] * (cols * rows)
+        points = []
+        active = []
+        r = self.spacing
+
+        def fits(x, y):
+            col = int((x - x_min) / cell)
+            row = int((y - y_min) / cell)
+            near = math.ceil(r / cell)
+            for j in range(max(row - near, 0), min(row + near + 1, rows)):
+                for i in range(max(col - near, 0), min(col + near + 1, cols)):
+                    k = grid[j * cols + i]
+                    if k >= 0 and (points[k][0] - x) ** 2 + (points[k][1] - y) ** 2 < r * r:
+                        return False
+            return True
+
+        def add(x, y):
+            grid[int((y - y_min) / cell) * cols + int((x - x_min) / cell)] = len(points)
+            active.append(len(points))
+            points.append((x, y))
+
+        add(rng.uniform(x_min, x_max), rng.uniform(y_min, y_max))
+        while True:
+            while active:
+                k = rng.randrange(len(active))
+                px, py = points[active[k]]
+                for t in range(self.tries):
+                    angle = rng.uniform(0, 2 * math.pi)
+                    dist = rng.uniform(r, 2 * r)
+                    x = px + dist * math.cos(angle)
+                    y = py + dist * math.sin(angle)
+                    if x_min <= x <= x_max and y_min <= y <= y_max and fits(x, y):
+                        add(x, y)
+                        break
+                else:
+                    active[k] = active[-1]
+                    active.pop()
+            if len(points) >= count or r <= self.min_spacing:
+                return points
+            # The number of points of a sample goes as 1 / spacing ** 2.
+            r = max(min(0.95 * r, r * math.sqrt(len(points) / count)), self.min_spacing)
+            active = list(range(len(points)))
+
+    def layout(self, seed, n_targets, n_walls, radius):
+        """
+        Returns the positions and colors of the targets and the positions and angles of the walls of the level
+        with the given seed. If there is no room for all the walls even with the smallest spacing, there are fewer
+        of them.
+        """
+        key = (seed, n_targets, n_walls, radius)
+        layout = self.levels.get(key)
+        if layout is not None:
+            self.levels.move_to_end(key)
+            return layout
+        rng = random.Random(seed)
+        points = self.sample(rng, n_targets + n_walls)
+        rng.shuffle(points)
+        points = [[int(x), int(y)] for x, y in points]
+        targets = tuple((coord, random_color(rng)) for coord in points[:n_targets])
+        walls = tuple((coord, rng.randint(-90, 90) * np.pi / 180)
+                      for coord in points[n_targets:n_targets + n_walls])
+        layout = (targets, walls)
+        self.levels[key] = layout
+        if len(self.levels) > self.max_levels:
+            self.levels.popitem(last=False)
+        return layout
+
+    def generate(self, seed, score=0, n_targets=3):
+        """
+        Makes the targets and the walls of a level. Targets get smaller and walls get more numerous as the score
+        grows.
+
+        :return: (targets, walls).
+        """
+        radius = max(int(30 - score), 3)
+        targets, walls = self.layout(seed, n_targets, 5 + score // 10, radius)
+        return ([Target(list(coord), rad=radius, color=color) for coord, color in targets],
+                [Wall(self.wall_length, self.wall_width, angle=angle, coords=coord) for coord, angle in walls])
+
+
+class FrameProfiler:
+    """
+    Measures how long each phase of Manager.process takes. Keeps the times of the last frames to compute rolling
+    percentiles, and the number of entities each phase worked on.
+    """
+    PHASES = ("events", "level", "collisions", "alive", "move", "draw")
+    CHUNK = 3600
+
+    def __init__(self, window=600, overlay=True):
+        """
+        :param window: number of last frames the percentiles are computed over.
+        :param overlay: if True, the percentiles are drawn over the game.
+
+        The rows of all the frames, which dump writes, are kept in blocks of CHUNK rows, so that a long game adds
+        a block now and then instead of a list per frame, and nothing already recorded is copied.
+        """
+        self.window = window
+        self.overlay = overlay
+        self.times = {phase: np.zeros(window, dtype=np.int64) for phase in self.PHASES}
+        self.frame_times = dict.fromkeys(self.PHASES, 0)
+        self.frame_counts = dict.fromkeys(self.PHASES, 0)
+        self.chunks = []
+        self.frames = 0
+        self.labels = [Label("", font_name="Courier New", size=14) for phase in self.PHASES]
+        self.lines = [""] * len(self.PHASES)
+
+    def record(self, phase, start, count=0):
         """
-        Draws the wall on the screen.
-        """
-        pg.draw.polygon(screen, self.color, self.vertexes)
-
-    def collision(self, ball):
-        """
-        Implements an elastic collision with the ball.
-        """
-        ball_coords = np.array([np.dot(ball.coords, self.normal),
-                                np.dot(ball.coords, self.parallel)])
-        wall_coords = np.array([np.dot(self.coords, self.normal),
-                                np.dot(self.coords, self.parallel)])
-
-        if abs(ball_coords[0] - wall_coords[0]) <= self.width / 2:
-            if ball_coords[1] - ball.rad <= wall_coords[1] + self.length / 2 <= ball_coords[1]:
-                ball.coords += (ball.vel * (-TIME_STEP)).astype(int)
-                ball.flip_vel(self.parallel, coef_perp=1, coef_par=1)
-            elif ball_coords[1] + ball.rad >= wall_coords[1] - self.length / 2 >= ball_coords[1]:
-                ball.coords += (ball.vel * (-TIME_STEP)).astype(int)
-                ball.flip_vel(self.parallel, coef_perp=1, coef_par=1)
-        elif abs(ball_coords[1] - wall_coords[1]) <= self.length / 2:
-            if ball_coords[0] - ball.rad <= wall_coords[0] + self.width / 2 <= ball_coords[0]:
-                ball.coords += (ball.vel * (-TIME_STEP)).astype(int)
-                ball.flip_vel(self.normal, coef_perp=1, coef_par=1)
-            elif ball_coords[0] + ball.rad >= wall_coords[0] - self.width / 2 >= ball_coords[0]:
-                ball.coords += (ball.vel * (-TIME_STEP)).astype(int)
-                ball.flip_vel(self.normal, coef_perp=1, coef_par=1)
+        Adds the time since start to the phase. Returns the current time, which is the start of the next phase.
+
+        :param phase: name of the phase.
+        :param start: value of perf_counter_ns() when the phase started.
+        :param count: number of entities the phase worked on.
+        """
+        now = perf_counter_ns()
+        self.frame_times[phase] += now - start
+        self.frame_counts[phase] = count
+        return now
+
+    def end_frame(self):
+        """
+        Saves the times of the frame and starts the next one.
+        """
+        i = self.frames % self.window
+        j = self.frames % self.CHUNK
+        if j == 0:
+            self.chunks.append(np.empty((self.CHUNK, 1 + 2 * len(self.PHASES)), dtype=np.int64))
+        row = self.chunks[-1][j]
+        row[0] = self.frames
+        for k, phase in enumerate(self.PHASES):
+            self.times[phase][i] = self.frame_times[phase]
+            row[1 + 2 * k] = self.frame_times[phase]
+            row[2 + 2 * k] = self.frame_counts[phase]
+            self.frame_times[phase] = 0
+        self.frames += 1
+
+    def summary(self):
+        """
+        Returns the p50, p95 and p99 time of every phase in milliseconds over the last frames and the number of
+        entities in the last frame.
+        """
+        n = min(self.frames, self.window)
+        result = {}
+        for phase in self.PHASES:
+            if n:
+                p50, p95, p99 = np.percentile(self.times[phase][:n], [50, 95, 99]) / 1e6
+            else:
+                p50 = p95 = p99 = 0.
+            result[phase] = {"p50": p50, "p95": p95, "p99": p99, "entities": self.frame_counts[phase]}
+        return result
+
+    def draw(self, screen, every=30):
+        """
+        Draws the percentiles in the top right corner of the screen. They are recomputed every few frames.
+        Returns the rectangle of the overlay.
+        """
+        if self.frames % every == 0:
+            summary = self.summary()
+            self.lines = ["%-10s %6.2f %6.2f %6.2f ms  n=%d" % (phase, s["p50"], s["p95"], s["p99"], s["entities"])
+                          for phase, s in summary.items()]
+        rects = [label.draw(screen, line, (SCREEN_SIZE[0] - 340, 16 * i))
+                 for i, (label, line) in enumerate(zip(self.labels, self.lines))]
+        return rects[0].unionall(rects[1:])
+
+    @property
+    def rows(self):
+        """
+        (frames, columns) array of the frame number and the time and the entity count of every phase of every frame.
+        """
+        if not self.chunks:
+            return np.zeros((0, 1 + 2 * len(self.PHASES)), dtype=np.int64)
+        return np.concatenate(self.chunks)[:self.frames]
+
+    def dump(self, path):
+        """
+        Writes the times of all the frames to a .csv file, or the summary and the times to a .json file.
+        """
+        header = ["frame"]
+        for phase in self.PHASES:
+            header += [phase + "_ns", phase + "_count"]
+        rows = self.rows.tolist()
+        if path.endswith(".csv"):
+            with open(path, "w", newline="") as output:
+                writer = csv.writer(output)
+                writer.writerow(header)
+                writer.writerows(rows)
         else:
-            for vertex in self.vertexes:
-                distance = np.linalg.norm(ball.coords - vertex)
-                if distance <= ball.rad:
-                    ball.coords += (ball.vel * (-TIME_STEP)).astype(int)
-                    normal = (ball.coords - vertex) / np.linalg.norm(ball.coords - vertex)
-                    ball.flip_vel(normal, coef_perp=1, coef_par=1)
+            with open(path, "w") as output:
+                json.dump({"summary": self.summary(), "columns": header, "frames": rows}, output)
+
+
+class DynamicResolution:
+    """
+    Chooses the resolution the game is drawn at from the measured frame times. When the average frame time of the
+    last frames is over the budget, the scale of the offscreen surface goes down by one step; when it is well under
+    the budget, the scale goes back up. The physics always works at full resolution.
+    """
+    def __init__(self, budget=1 / FPS, min_scale=0.5, step=0.125, window=30, headroom=0.7):
+        """
+        :param budget: time in seconds a frame should take.
+        :param min_scale: smallest scale of the offscreen surface.
+        :param step: change of the scale at once.
+        :param window: number of frames the frame time is averaged over before the scale changes.
+        :param headroom: the scale goes up when the average frame time is less than headroom * budget.
+        """
+        self.budget = budget
+        self.min_scale = min_scale
+        self.step = step
+        self.window = window
+        self.headroom = headroom
+        self.scale = 1.
+        self.times = deque(maxlen=window)
+        self.frame_time = 0.
+        self.changes = 0
+
+    def update(self, frame_time):
+        """
+        Adds the time in seconds the last frame took. Returns the scale for the next frame.
+        """
+        self.times.append(frame_time)
+        if len(self.times) < self.window:
+            return self.scale
+        self.frame_time = sum(self.times) / len(self.times)
+        scale = self.scale
+        if self.frame_time > self.budget:
+            scale = max(self.min_scale, scale - self.step)
+        elif self.frame_time < self.headroom * self.budget:
+            scale = min(1., scale + self.step)
+        if scale != self.scale:
+            self.scale = scale
+            self.changes += 1
+            self.times.clear()
+        return self.scale
+
+    def report(self):
+        """
+        Returns a dictionary with the current scale, the budget and the average frame time in seconds, and the
+        number of times the scale has changed.
+        """
+        return {"scale": self.scale, "budget": self.budget, "frame_time": self.frame_time, "changes": self.changes}
+
+
+RECORDING_MAGIC = b"GUNR"
+RECORDING_VERSION = 4
+RECORDING_HEADER = struct.Struct("<4sHQHH")
+RECORDING_FRAME = struct.Struct("<dhhH")
+RECORDING_EVENT = struct.Struct("<HI")
+NO_MOUSE = -32768
+
+
+class InputRecorder:
+    """
+    Writes the input of a game to a compact binary file: a header with the seed, the number of sub-steps and the
+    number of balls per shot, then
+    for every frame the frame time, the mouse position and the events the game reacts to. Frames are collected in
+    memory and written in big blocks, so recording does not make the game wait for the disk.
+    """
+    def __init__(self, path, buffer_size=1 << 16):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.buffer = bytearray()
+        self.file = None
+        self.frames = 0
+
+    def start(self, seed, substeps, barrage):
+        """
+        Opens the file and writes the header.
+        """
+        self.file = open(self.path, "wb")
+        self.buffer += RECORDING_HEADER.pack(RECORDING_MAGIC, RECORDING_VERSION, seed, substeps, barrage)
+
+    def record(self, dt, mouse_pos, events):
+        """
+        Adds a frame to the recording.
+        """
+        if mouse_pos is None:
+            mouse_pos = (NO_MOUSE, NO_MOUSE)
+        kept = []
+        for event in events:
+            if event.type == pg.QUIT:
+                kept.append((event.type, 0))
+            elif event.type in (pg.KEYDOWN, pg.KEYUP):
+                kept.append((event.type, event.key))
+            elif event.type in (pg.MOUSEBUTTONDOWN, pg.MOUSEBUTTONUP):
+                kept.append((event.type, event.button))
+        self.buffer += RECORDING_FRAME.pack(math.nan if dt is None else dt,
+                                            int(mouse_pos[0]), int(mouse_pos[1]), len(kept))
+        for event in kept:
+            self.buffer += RECORDING_EVENT.pack(*event)
+        self.frames += 1
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        self.file.write(self.buffer)
+        self.buffer.clear()
+
+    def close(self):
+        """
+        Writes the rest of the frames and closes the file.
+        """
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+
+def read_recording(path):
+    """
+    Reads a file written by InputRecorder.
+
+    :return: (seed, substeps, barrage, frames). frames is a list of (events, mouse_pos, dt) triples, like the ones
+     run_headless takes.
+    """
+    with open(path, "rb") as inp:
+        data = inp.read()
+    magic, version, seed, substeps, barrage = RECORDING_HEADER.unpack_from(data, 0)
+    if magic != RECORDING_MAGIC or version != RECORDING_VERSION:
+        raise ValueError("%s is not a recording of the gun game" % path)
+    offset = RECORDING_HEADER.size
+    frames = []
+    while offset < len(data):
+        dt, x, y, n = RECORDING_FRAME.unpack_from(data, offset)
+        offset += RECORDING_FRAME.size
+        events = []
+        for i in range(n):
+            kind, code = RECORDING_EVENT.unpack_from(data, offset)
+            offset += RECORDING_EVENT.size
+            if kind in (pg.KEYDOWN, pg.KEYUP):
+                events.append(pg.event.Event(kind, key=code))
+            elif kind in (pg.MOUSEBUTTONDOWN, pg.MOUSEBUTTONUP):
+                events.append(pg.event.Event(kind, button=code))
+            else:
+                events.append(pg.event.Event(kind))
+        mouse_pos = None if x == NO_MOUSE else (x, y)
+        frames.append((events, mouse_pos, None if math.isnan(dt) else dt))
+    return seed, substeps, barrage, frames
+
+
+class Snapshot:
+    """
+    Copy of everything Manager.draw needs at one moment of the game. It is not changed after it is made, so one
+    thread can draw it while another one goes on with the game.
+    """
+    def __init__(self, manager):
+        self.gun = manager.gun.copy()
+        self.balls = manager.balls.copy()
+        self.targets = tuple(manager.targets)
+        self.walls = tuple(manager.walls)
+        self.table = ScoreTable(manager.table.targets_hit, manager.table.balls_used)
+        self.level = manager.level
+        self.version = manager.version
+        self.alpha = manager.alpha
+        self.done = manager.done
 
 
 class Manager:
     """
     Manages the process of the game.
     """
-    def __init__(self):
+    def __init__(self, seed=None, dirty_rects=False, substeps=1, recorder=None, profiler=None, barrage=1,
+                 ball_collisions=True, resolution=None):
         """
         Creates a game: guns, balls, targets and a score table. Creates variables to monitor the state of the game.
+
+        :param seed: seed of the random number generator of the game. Games with the same seed and the same input
+         are identical. A random seed is chosen if it is not given.
+        :param dirty_rects: if True, only the parts of the screen that changed are redrawn and updated.
+        :param substeps: number of physics sub-steps in one tick. More sub-steps keep fast balls from passing
+         through walls.
+        :param recorder: InputRecorder, which writes down the input of the game so that it can be replayed.
+        :param profiler: FrameProfiler, which measures the phases of every frame.
+        :param barrage: number of balls the gun shoots at once.
+        :param ball_collisions: if True, balls bounce off each other.
+        :param resolution: DynamicResolution, which sets the resolution the game is drawn at. The game is drawn at
+         the resolution of the screen if it is None.
         """
+        if seed is None:
+            seed = random.randrange(2 ** 32)
+        self.seed = seed
+        self.rng = random.Random(seed)
         self.gun = Gun()
         self.table = ScoreTable()
-        self.balls = []
+        self.balls = BallArray()
         self.targets = []
         self.walls = []
+        self.wall_rects = wall_rects(self.walls)
+        self.levels = LevelGenerator()
+        self.level_seed = None
+        self.grid = BallGrid()
+        self.sap = SweepAndPrune()
+        self.barrage = barrage
+        self.ball_collisions = ball_collisions
+        self.ball_contacts = 0
+        self.dirty_rects = dirty_rects
+        self.substeps = substeps
+        self.accumulator = 0.
+        self.alpha = 1.
+        self.level = 0
+        self.version = 0
+        self.preview = TrajectoryPreview()
+        self.shown_table = ScoreTable()
+        self.background = None
+        self.drawn_level = None
+        self.drawn_version = None
+        self.prev_rects = []
+        self.table_rects = []
+        self.resolution = resolution
+        self.offscreen = None
         self.done = False
         self.up_key_pressed = False
         self.down_key_pressed = False
+        self.profiler = profiler
+        self.recorder = recorder
+        if recorder is not None:
+            recorder.start(seed, substeps, barrage)
 
-    def process(self, events, screen):
+    def process(self, events, screen=None, mouse_pos=None, dt=None):
         """
-        Manages the game. If all the targets have been hit, creates new ones.
+        Manages the game for one frame. The physics runs in ticks of fixed length 1 / SIM_RATE seconds, so the
+        speed of the game does not depend on the frame rate.
+
+        :param events: events that happened since the previous frame.
+        :param screen: screen to draw on. Nothing is drawn if it is None.
+        :param mouse_pos: position of the mouse. It is taken from pg.mouse if it is not given.
+        :param dt: real time in seconds since the previous frame. If it is None, exactly one tick is made.
+        :return: list of the changed rectangles of the screen, if there is a screen.
+        """
+        prof = self.profiler
+        if prof is not None:
+            start = perf_counter_ns()
+        if mouse_pos is None:
+            mouse_pos = poll_mouse()
+        if self.recorder is not None:
+            self.recorder.record(dt, mouse_pos, events)
+        self.handle_events(events, mouse_pos)
+        if prof is not None:
+            prof.record("events", start, len(events))
+
+        if dt is None:
+            ticks = 1
+            alpha = 1.
+        else:
+            self.accumulator += dt
+            ticks = min(int(self.accumulator * SIM_RATE), MAX_TICKS_PER_FRAME)
+            self.accumulator -= ticks / SIM_RATE
+            if ticks == MAX_TICKS_PER_FRAME:
+                self.accumulator = min(self.accumulator, 1 / SIM_RATE)
+            alpha = self.accumulator * SIM_RATE
+        self.alpha = alpha
+
+        for i in range(ticks):
+            self.tick()
+        rects = None
+        if screen is not None:
+            if prof is not None:
+                start = perf_counter_ns()
+            rects = self.draw(screen, alpha)
+            if prof is not None:
+                prof.record("draw", start, len(self.balls) + len(self.targets) + len(self.walls))
+        if prof is not None:
+            prof.end_frame()
+        return rects
+
+    def tick(self):
         """
-        self.handle_events(events)
+        Advances the game by one physics tick. If all the targets have been hit, creates new ones.
+        """
+        prof = self.profiler
+        if prof is not None:
+            start = perf_counter_ns()
+        self.move_gun()
 
         if len(self.targets) == 0 and len(self.balls) == 0:
-            radius = max(int(30 - self.table.score), 3)
-            self.targets = [Target([randint(100, SCREEN_SIZE[0] - 30),
-                                    randint(30, SCREEN_SIZE[1] - 30)],
-                                   rad=radius) for i in range(3)]
-            n = 5 + self.table.score // 10
-            self.walls = [Wall(100, 25, coords=[100 + int((SCREEN_SIZE[0] - 200) * (i + 1) / n),
-                                                randint(100, SCREEN_SIZE[1] - 100)],
-                               angle=randint(-90, 90) * np.pi / 180) for i in range(n)]
-
-        self.check_collisions()
-        self.check_alive()
-        self.move()
-        self.draw(screen)
+            self.level_seed = self.rng.getrandbits(32)
+            self.targets, self.walls = self.levels.generate(self.level_seed, self.table.score)
+            self.wall_rects = wall_rects(self.walls)
+            self.level += 1
+            self.version += 1
+        if prof is not None:
+            start = prof.record("level", start, len(self.targets) + len(self.walls))
 
-    def draw(self, screen):
+        self.balls.save_positions()
+        self.grid.reset_counters()
+        t_step = TIME_STEP / self.substeps
+        for i in range(self.substeps):
+            self.check_collisions()
+            if prof is not None:
+                start = prof.record("collisions", start, len(self.balls))
+            self.check_alive()
+            if prof is not None:
+                start = prof.record("alive", start, len(self.balls))
+            self.balls.move(t_step, walls=self.walls, grid=self.grid, rects=self.wall_rects)
+            if prof is not None:
+                start = prof.record("move", start, len(self.balls))
+            if self.ball_collisions:
+                self.ball_contacts = collide_balls(self.balls, *self.sap.pairs(self.balls))
+                if prof is not None:
+                    start = prof.record("collisions", start, len(self.balls))
+        self.gun.gain_power()
+
+    def digest(self):
         """
-        Draws all the objects, which have to drawn on the screen.
+        Returns a hash of the state of the game. Two games in the same state have the same digest.
         """
-        screen.fill(BLACK)
-        self.gun.draw(screen)
-        for ball in self.balls:
-            ball.draw(screen)
+        n = len(self.balls)
+        h = hashlib.sha1()
+        for arr in (self.balls.coords[:n], self.balls.vel[:n], self.balls.color[:n], self.gun.coords):
+            h.update(np.ascontiguousarray(arr).tobytes())
         for target in self.targets:
+            h.update(repr((target.coord, target.rad, target.color)).encode())
+        h.update(repr((self.gun.power, self.table.targets_hit, self.table.balls_used)).encode())
+        return h.hexdigest()
+
+    def snapshot(self):
+        """
+        Returns a Snapshot of the current state of the game.
+        """
+        return Snapshot(self)
+
+    def draw(self, screen, alpha=1., scene=None):
+        """
+        Draws all the objects, which have to drawn on the screen. Returns the list of rectangles of the screen,
+        which have changed.
+
+        :param alpha: position of the frame between the two last physics ticks, used to interpolate the balls.
+        :param scene: Snapshot to draw. The current state of the game is drawn if it is None.
+        """
+        if scene is None:
+            scene = self
+        if scene.level != self.drawn_level:
+            self.preview.invalidate()
+            self.drawn_level = scene.level
+        self.shown_table.targets_hit = scene.table.targets_hit
+        self.shown_table.balls_used = scene.table.balls_used
+        if self.resolution is not None and self.resolution.scale != 1.:
+            return self.draw_scaled(screen, alpha, scene, self.resolution.scale)
+        if self.dirty_rects:
+            return self.draw_dirty(screen, alpha, scene)
+        screen.fill(BLACK)
+        if scene.gun.active:
+            self.preview.draw(screen, scene.gun, scene.walls)
+        scene.gun.draw(screen)
+        scene.balls.draw(screen, alpha)
+        for target in scene.targets:
             target.draw(screen)
-        self.table.draw(screen)
-        for wall in self.walls:
+        self.shown_table.draw(screen)
+        for wall in scene.walls:
             wall.draw(screen)
+        rects = [screen.get_rect()]
+        if self.profiler is not None and self.profiler.overlay:
+            self.profiler.draw(screen)
+        return rects
 
-    def move(self):
+    def draw_scaled(self, screen, alpha, scene, scale):
         """
-        Moves all the objects, which have to be moved.
+        Draws the game on an offscreen surface scale times smaller than the screen and stretches it over the
+        screen. The score table and the profiler overlay are drawn over it at full resolution.
         """
-        for ball in self.balls:
-            ball.move()
-        self.gun.gain_power()
+        size = (round(screen.get_width() * scale), round(screen.get_height() * scale))
+        if self.offscreen is None or self.offscreen.get_size() != size:
+            self.offscreen = pg.Surface(size, 0, screen)
+        surface = self.offscreen
+        surface.fill(BLACK)
+        if scene.gun.active:
+            self.preview.draw(surface, scene.gun, scene.walls, scale)
+        scene.gun.draw(surface, scale)
+        scene.balls.draw(surface, alpha, scale)
+        for target in scene.targets:
+            target.draw(surface, scale)
+        for wall in scene.walls:
+            wall.draw(surface, scale)
+        pg.transform.scale(surface, screen.get_size(), screen)
+        self.table_rects = self.shown_table.draw(screen)
+        if self.profiler is not None and self.profiler.overlay:
+            self.profiler.draw(screen)
+        # The dirty rectangles mode starts from a full redraw when the scale goes back to 1.
+        self.background = None
+        return [screen.get_rect()]
+
+    def draw_dirty(self, screen, alpha=1., scene=None):
+        """
+        Redraws only the regions of the screen, where the balls, the gun and the score table were in the previous
+        frame and where they are now. Walls and targets are kept on a background surface, which is rebuilt only when
+        they change.
+        """
+        if scene is None:
+            scene = self
+        if self.background is None or scene.version != self.drawn_version:
+            self.background = pg.Surface(screen.get_size())
+            self.background.fill(BLACK)
+            for target in scene.targets:
+                target.draw(self.background)
+            for wall in scene.walls:
+                wall.draw(self.background)
+            self.drawn_version = scene.version
+            screen.blit(self.background, (0, 0))
+            rects = [screen.get_rect()]
+        else:
+            rects = self.prev_rects
+            if self.shown_table.changed():
+                rects = rects + self.table_rects
+            for rect in rects:
+                screen.blit(self.background, rect, rect)
+
+        table_changed = self.shown_table.changed()
+        self.prev_rects = []
+        if scene.gun.active:
+            rect = self.preview.draw(screen, scene.gun, scene.walls)
+            if rect is not None:
+                self.prev_rects.append(rect)
+        self.prev_rects += scene.balls.draw(screen, alpha)
+        self.prev_rects.append(scene.gun.draw(screen))
+        self.table_rects = self.shown_table.draw(screen)
+        if table_changed:
+            rects = rects + self.table_rects
+        if self.profiler is not None and self.profiler.overlay:
+            self.prev_rects.append(self.profiler.draw(screen))
+        return rects + self.prev_rects
+
+    def move_gun(self):
+        """
+        Moves the gun up or down while the keys are held.
+        """
+        if self.up_key_pressed:
+            self.gun.coords[1] = max(10, self.gun.coords[1] - 5)
+        if self.down_key_pressed:
+            self.gun.coords[1] = min(SCREEN_SIZE[1] - 10, self.gun.coords[1] + 5)
 
     def check_alive(self):
         """
-        Checks if the balls are still moving and if the targets have not been hit yet.
-        """
-        dead_balls = []
-        for i, ball in enumerate(self.balls):
-            if not ball.is_alive:
-                dead_balls.append(i)
-        for i in reversed(dead_balls):
-            self.balls.pop(i)
-        dead_targets = []
-        for i, target in enumerate(self.targets):
-            if not target.is_alive:
-                dead_targets.append(i)
-        for i in reversed(dead_targets):
-            self.targets.pop(i)
+        Checks if the balls are still moving and if the targets have not been hit yet. Dead balls are compacted out
+        of the pool, dead targets are swapped with the last one and popped.
+        """
+        keep = self.balls.cull()
+        if keep is not None:
+            self.sap.remove(keep)
+        targets = self.targets
+        i = 0
+        while i < len(targets):
+            if targets[i].is_alive:
+                i += 1
+            else:
+                targets[i] = targets[-1]
+                targets.pop()
+                self.version += 1
 
     def check_collisions(self):
         """
-        Checks if the balls have hit some targets.
+        Checks if the balls have hit some targets. Only the balls the grid finds near a target are checked against
+        it. Collisions with walls are handled while the balls move.
         """
-        for target in self.targets:
-            for ball in self.balls:
-                if target.check_collision(ball):
-                    target.is_alive = False
-                    self.table.targets_hit += 1
+        self.grid.rebuild(self.balls)
+        self.grid.all_pairs += len(self.targets) * len(self.balls)
 
-        for wall in self.walls:
-            for ball in self.balls:
-                wall.collision(ball)
+        for target in self.targets:
+            x, y = target.coord
+            idx = self.grid.query(self.balls, x - target.rad, y - target.rad, x + target.rad, y + target.rad)
+            hits = int(np.count_nonzero(target.check_collisions(self.balls, idx)))
+            if hits:
+                target.is_alive = False
+                self.table.targets_hit += hits
 
-    def handle_events(self, events):
+    def handle_events(self, events, mouse_pos=None):
         """
-        Handles the events.
+        Handles the events. The gun aims at mouse_pos, or at the mouse if mouse_pos is not given.
         """
 
         for event in events:
@@ -359,22 +1799,105 @@ class Manager:
                     self.gun.active = True
             elif event.type == pg.MOUSEBUTTONUP:
                 if event.button == 1:
-                    self.balls.append(self.gun.shoot())
-                    self.table.balls_used += 1
+                    if self.barrage > 1:
+                        self.gun.shoot_barrage(self.balls, [random_color(self.rng) for i in range(self.barrage)])
+                    else:
+                        self.gun.shoot(self.balls, color=random_color(self.rng))
+                    self.table.balls_used += self.barrage
 
-        if self.up_key_pressed:
-            self.gun.coords[1] = max(10, self.gun.coords[1] - 5)
-        if self.down_key_pressed:
-            self.gun.coords[1] = min(SCREEN_SIZE[1] - 10, self.gun.coords[1] + 5)
-
-        if pg.mouse.get_focused():
-            mouse_pos = pg.mouse.get_pos()
+        if mouse_pos is None:
+            mouse_pos = poll_mouse()
+        if mouse_pos is not None:
             self.gun.set_angle(mouse_pos)
 
 
-def main():
+class SimulationThread(threading.Thread):
+    """
+    Runs the physics of a game in its own thread. The render thread pushes the input of every frame into a deque,
+    the simulation thread processes it and publishes a new Snapshot, which the render thread draws. deque.append
+    and deque.popleft are atomic, so the threads share no locks; the snapshot is published by swapping a reference.
+    Once the game is done, the input that comes after is neither processed nor recorded, so the recording ends
+    where a replay of it stops.
+    """
+    def __init__(self, manager):
+        super().__init__(daemon=True)
+        self.manager = manager
+        self.inbox = deque()
+        self.wakeup = threading.Event()
+        self.snapshot = manager.snapshot()
+        self.running = True
+        self.error = None
+
+    def push(self, events, mouse_pos, dt):
+        """
+        Passes the input of a frame to the simulation. Called from the render thread.
+        """
+        self.inbox.append((events, mouse_pos, dt))
+        self.wakeup.set()
+
+    def run(self):
+        try:
+            self.simulate()
+        except BaseException as error:
+            # The render thread waits for a done snapshot; stop() raises the error there.
+            self.error = error
+            snapshot = copy.copy(self.snapshot)
+            snapshot.done = True
+            self.snapshot = snapshot
+
+    def simulate(self):
+        manager = self.manager
+        while self.running and not manager.done:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            while self.inbox and not manager.done:
+                # The input of the frames the simulation has fallen behind on is processed at once. Frames of one
+                # tick each (dt is None) are kept apart, so that no tick is lost.
+                events, mouse_pos, dt = self.inbox.popleft()
+                while self.inbox and dt is not None and self.inbox[0][2] is not None:
+                    more_events, mouse_pos, more_dt = self.inbox.popleft()
+                    events = events + more_events
+                    dt += more_dt
+                manager.process(events, mouse_pos=mouse_pos, dt=dt)
+                self.snapshot = manager.snapshot()
+
+    def stop(self):
+        """
+        Stops the thread after it processes the input it already has. Raises the exception, which stopped the
+        simulation, if there was one.
+        """
+        self.running = False
+        self.wakeup.set()
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+
+def poll_mouse():
+    """
+    Returns the position of the mouse, or None if there is no window or it is not focused.
+    """
+    if pg.display.get_init() and pg.mouse.get_focused():
+        return pg.mouse.get_pos()
+    return None
+
+
+def main(dirty_rects=False, fps=FPS, substeps=1, record=None, profile=None, barrage=1, threaded=False,
+         budget=None):
     """
     Creates a screen, starts a game by calling a manager.
+
+    :param dirty_rects: if True, only the changed parts of the screen are redrawn and pushed to the display.
+    :param fps: frame rate of rendering. It does not change the speed of the game.
+    :param substeps: number of physics sub-steps in one tick.
+    :param record: path of the file to record the input of the game to.
+    :param profile: path of the .csv or .json file to write the times of the phases of every frame to.
+     The percentiles are shown over the game.
+    :param barrage: number of balls the gun shoots at once.
+    :param threaded: if True, the physics runs in a separate thread, and the main thread draws the last published
+     snapshot of the game, so simulation and rendering of consecutive frames overlap.
+    :param budget: time in seconds a frame may take. If it is given, the game is drawn at a lower resolution
+     while frames take longer than that.
     """
     pg.init()
     screen = pg.display.set_mode(SCREEN_SIZE)
@@ -382,17 +1905,187 @@ def main():
 
     done = False
 
-    manager = Manager()
+    recorder = InputRecorder(record) if record is not None else None
+    profiler = FrameProfiler() if profile is not None else None
+    resolution = DynamicResolution(budget) if budget is not None else None
+    manager = Manager(dirty_rects=dirty_rects, substeps=substeps, recorder=recorder, profiler=profiler,
+                      barrage=barrage, resolution=resolution)
+    simulation = SimulationThread(manager) if threaded else None
+    if simulation is not None:
+        simulation.start()
     while not done:
-        clock.tick(FPS)
+        dt = clock.tick(fps) / 1000
+        if resolution is not None:
+            resolution.update(clock.get_rawtime() / 1000)
+
+        if simulation is None:
+            rects = manager.process(pg.event.get(), screen, dt=dt)
+            done = manager.done
+        else:
+            simulation.push(pg.event.get(), poll_mouse(), dt)
+            snapshot = simulation.snapshot
+            rects = manager.draw(screen, snapshot.alpha, scene=snapshot)
+            done = snapshot.done
+
+        pg.display.update(rects)
+
+    try:
+        if simulation is not None:
+            simulation.stop()
+    finally:
+        if recorder is not None:
+            recorder.close()
+        if profiler is not None:
+            profiler.dump(profile)
+        pg.quit()
+
+
+def scripted_input(seed=0, frames=3600, quit_at=None, dt=None):
+    """
+    Generates the input of a simple player: it aims at a random point, holds the mouse button for a random number
+    of frames and releases it.
+
+    :param seed: seed of the player's random number generator.
+    :param frames: number of frames to generate.
+    :param quit_at: number of the frame, in which the player closes the window. Frames go on after it, the way a
+     window keeps producing them until the game notices.
+    :param dt: length of a frame in seconds. If it is None, every frame is one tick.
+    :return: iterator of (events, mouse_pos, dt) triples, one per frame.
+    """
+    rng = random.Random(seed)
+    mouse_pos = (SCREEN_SIZE[0] // 2, SCREEN_SIZE[1] // 2)
+    hold = 0
+    for frame in range(frames):
+        events = []
+        if hold == 0:
+            mouse_pos = (rng.randint(0, SCREEN_SIZE[0]), rng.randint(0, SCREEN_SIZE[1]))
+            events.append(pg.event.Event(pg.MOUSEBUTTONDOWN, button=1))
+            hold = rng.randint(1, 40)
+        else:
+            hold -= 1
+            if hold == 0:
+                events.append(pg.event.Event(pg.MOUSEBUTTONUP, button=1))
+        if frame == quit_at:
+            events.append(pg.event.Event(pg.QUIT))
+        yield events, mouse_pos, dt
 
-        manager.process(pg.event.get(), screen)
-        done = manager.done
 
-        pg.display.update()
+def run_headless(script, seed=0, substeps=1, record=None, profile=None, barrage=1, threaded=False):
+    """
+    Runs the game without a window and without waiting between frames.
 
-    pg.quit()
+    :param script: iterable of (events, mouse_pos, dt) triples, one per frame. If dt is None, the frame is one
+     physics tick.
+    :param seed: seed of the game.
+    :param substeps: number of physics sub-steps in one tick.
+    :param record: path of the file to record the input of the game to.
+    :param profile: path of the .csv or .json file to write the times of the phases of every frame to.
+    :param barrage: number of balls the gun shoots at once.
+    :param threaded: if True, the frames are pushed to a SimulationThread the way main does it in the threaded
+     mode, until the published snapshot is done. A frame is pushed when the simulation has taken the previous one,
+     as it happens when rendering is slower than the physics.
+    :return: dictionary with the number of frames, simulated frames per second, the score and the digest of the
+     final state of the game.
+    """
+    recorder = InputRecorder(record) if record is not None else None
+    profiler = FrameProfiler(overlay=False) if profile is not None else None
+    manager = Manager(seed=seed, substeps=substeps, recorder=recorder, profiler=profiler, barrage=barrage)
+    simulation = SimulationThread(manager) if threaded else None
+    if simulation is not None:
+        simulation.start()
+    frames = 0
+    start = perf_counter()
+    for events, mouse_pos, dt in script:
+        if simulation is None:
+            manager.process(events, mouse_pos=mouse_pos, dt=dt)
+            done = manager.done
+        else:
+            simulation.push(events, mouse_pos, dt)
+            while simulation.inbox and simulation.is_alive():
+                sleep(0)
+            done = simulation.snapshot.done
+        frames += 1
+        if done:
+            break
+    if simulation is not None:
+        simulation.stop()
+    elapsed = perf_counter() - start
+    if recorder is not None:
+        recorder.close()
+    if profiler is not None:
+        profiler.dump(profile)
+    return {"frames": frames,
+            "seconds": elapsed,
+            "fps": frames / elapsed if elapsed > 0 else float("inf"),
+            "targets_hit": manager.table.targets_hit,
+            "balls_used": manager.table.balls_used,
+            "score": manager.table.score,
+            "digest": manager.digest(),
+            "pool": manager.balls.pool_stats()}
+
+
+def replay(path, profile=None):
+    """
+    Replays a recorded game without a window as fast as possible. Levels and scores are the same as in the
+    recorded game.
+
+    :param path: file written by InputRecorder.
+    :param profile: path of the .csv or .json file to write the times of the phases of every frame to.
+    :return: the result of run_headless.
+    """
+    seed, substeps, barrage, frames = read_recording(path)
+    return run_headless(frames, seed=seed, substeps=substeps, profile=profile, barrage=barrage)
+
+
+def check_replay(seed=0, frames=600, threaded=False, substeps=1, barrage=1):
+    """
+    Plays a scripted game, in which the player quits before the script ends, records it and replays the
+    recording. Checks that the replay ends in the same state as the recorded game.
+
+    :return: (digest of the recorded game, digest of the replay).
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = directory + "/check.rec"
+        script = scripted_input(seed, frames, quit_at=frames * 3 // 4, dt=1 / FPS)
+        played = run_headless(script, seed=seed, substeps=substeps, record=path, barrage=barrage, threaded=threaded)
+        replayed = replay(path)
+    return played["digest"], replayed["digest"]
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Gun game.")
+    parser.add_argument("--headless", action="store_true", help="run a scripted game without a window")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the headless game")
+    parser.add_argument("--frames", type=int, default=3600, help="number of frames of the headless game")
+    parser.add_argument("--dirty-rects", action="store_true", help="redraw only the changed parts of the screen")
+    parser.add_argument("--fps", type=int, default=FPS, help="frame rate of rendering")
+    parser.add_argument("--substeps", type=int, default=1, help="number of physics sub-steps in one tick")
+    parser.add_argument("--record", help="file to record the input of the game to")
+    parser.add_argument("--replay", help="recorded game to replay without a window")
+    parser.add_argument("--profile", help="show frame times and write them to this .csv or .json file at exit")
+    parser.add_argument("--barrage", type=int, default=1, help="number of balls the gun shoots at once")
+    parser.add_argument("--threaded", action="store_true", help="run the physics and the rendering in two threads")
+    parser.add_argument("--budget", type=float, help="frame time budget in milliseconds; frames over it are drawn "
+                                                     "at a lower resolution")
+    parser.add_argument("--check-replay", action="store_true",
+                        help="check that a recorded scripted game replays to the same state")
+    args = parser.parse_args()
+    if args.check_replay:
+        played, replayed = check_replay(args.seed, args.frames, threaded=args.threaded, substeps=args.substeps,
+                                        barrage=args.barrage)
+        print("recorded:", played)
+        print("replayed:", replayed)
+        sys.exit(0 if played == replayed else 1)
+    elif args.headless or args.replay:
+        if args.replay:
+            result = replay(args.replay, profile=args.profile)
+        else:
+            result = run_headless(scripted_input(args.seed, args.frames), seed=args.seed, substeps=args.substeps,
+                                  record=args.record, profile=args.profile, barrage=args.barrage,
+                                  threaded=args.threaded)
+        for key, value in result.items():
+            print(key + ":", value)
+    else:
+        main(dirty_rects=args.dirty_rects, fps=args.fps, substeps=args.substeps, record=args.record,
+             profile=args.profile, barrage=args.barrage, threaded=args.threaded,
+             budget=args.budget / 1000 if args.budget is not None else None)
@@ -0,0 +1,145 @@
+"""
+Finds which shots of the gun hit the targets of a level.
+
+Every (angle, power) pair of a grid is shot from the gun and simulated with the physics of gun.py. The grid is
+split into chunks, which are simulated in parallel by a pool of processes, all the shots of a chunk at once.
+The result is a boolean hit map of shape (angles, powers) for every target.
+"""
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+
+import numpy as np
+
+import gun
+
+_level = None
+
+
+def make_level(seed, score=0):
+    """
+    Generates a level the same way the game does.
+
+    :param seed: seed of the game.
+    :param score: score of the player, on which the number of walls and the size of the targets depend.
+    :return: (gun coordinates, targets, walls).
+    """
+    manager = gun.Manager(seed=seed)
+    manager.table.targets_hit = score
+    manager.tick()
+    return manager.gun.coords.copy(), manager.targets, manager.walls
+
+
+def shot_velocities(angles, powers):
+    """
+    Returns the velocities of the shells for all the (angle, power) pairs, angle-major, the same as Gun.shoot gives.
+    """
+    angle, power = np.meshgrid(angles, powers, indexing="ij")
+    vel = np.stack([np.trunc(power * np.cos(angle)), np.trunc(power * np.sin(angle))], axis=-1)
+    return vel.reshape(-1, 2)
+
+
+def simulate_shots(coords, vel, targets, walls, steps=600, substeps=1):
+    """
+    Shoots all the shells at once and follows them until they stop or the steps run out.
+
+    :param coords: coordinates of the gun.
+    :param vel: (n, 2) initial velocities of the shells.
+    :param targets: targets of the level.
+    :param walls: walls of the level.
+    :param steps: maximum number of physics ticks.
+    :param substeps: number of sub-steps in one tick.
+    :return: boolean array of shape (len(targets), n), True where the shell touched the target.
+    """
+    balls = gun.BallArray(capacity=len(vel))
+    balls.add_many(coords, vel)
+    shots = np.arange(len(vel))
+    grid = gun.BallGrid()
+    rects = gun.wall_rects(walls)
+    hits = np.zeros((len(targets), len(vel)), dtype=bool)
+    t_step = gun.TIME_STEP / substeps
+    for step in range(steps * substeps):
+        grid.rebuild(balls)
+        for j, target in enumerate(targets):
+            x, y = target.coord
+            idx = grid.query(balls, x - target.rad, y - target.rad, x + target.rad, y + target.rad)
+            hits[j, shots[idx[target.check_collisions(balls, idx)]]] = True
+        alive = balls.alive[:len(balls)].copy()
+        balls.cull()
+        shots = shots[alive]
+        if len(balls) == 0:
+            break
+        balls.move(t_step, walls=walls, grid=grid, rects=rects)
+    return hits
+
+
+def _init_worker(level):
+    global _level
+    _level = level
+
+
+def _sweep_chunk(chunk):
+    coords, targets, walls, steps, substeps = _level
+    start, vel = chunk
+    return start, simulate_shots(coords, vel, targets, walls, steps, substeps)
+
+
+def sweep(coords, targets, walls, angles, powers, steps=600, substeps=1, workers=None, chunk_size=4096):
+    """
+    Simulates every (angle, power) shot on a pool of processes.
+
+    :param workers: number of processes. All the cores are used by default.
+    :param chunk_size: number of shots simulated together by one task.
+    :return: boolean hit map of shape (len(targets), len(angles), len(powers)).
+    """
+    vel = shot_velocities(angles, powers)
+    chunks = [(start, vel[start:start + chunk_size]) for start in range(0, len(vel), chunk_size)]
+    hits = np.zeros((len(targets), len(vel)), dtype=bool)
+    level = (coords, targets, walls, steps, substeps)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(level,)) as pool:
+        for start, chunk_hits in pool.map(_sweep_chunk, chunks):
+            hits[:, start:start + chunk_hits.shape[1]] = chunk_hits
+    return hits.reshape(len(targets), len(angles), len(powers))
+
+
+def save(path, angles, powers, targets, hits):
+    """
+    Writes the hit maps to a compressed .npz file: one array "target_<i>" per target, the grid and the targets.
+    """
+    maps = {"target_%d" % j: hits[j] for j in range(len(targets))}
+    np.savez_compressed(path, angles=angles, powers=powers,
+                        target_coords=np.array([t.coord for t in targets]),
+                        target_rads=np.array([t.rad for t in targets]), **maps)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hit maps of a level of the gun game.")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the level")
+    parser.add_argument("--score", type=int, default=0, help="score the level is generated for")
+    parser.add_argument("--angles", type=int, default=360, help="number of angles from -90 to 90 degrees")
+    parser.add_argument("--steps", type=int, default=600, help="maximum number of ticks of a shot")
+    parser.add_argument("--substeps", type=int, default=1, help="number of sub-steps in one tick")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of processes")
+    parser.add_argument("--chunk-size", type=int, default=4096, help="number of shots in one task")
+    parser.add_argument("--out", default="hits.npz", help="file to write the hit maps to")
+    args = parser.parse_args()
+
+    coords, targets, walls = make_level(args.seed, args.score)
+    probe = gun.Gun()
+    angles = np.linspace(-np.pi / 2, np.pi / 2, args.angles)
+    powers = np.arange(probe.min_pow, probe.max_pow + 1)
+
+    start = perf_counter()
+    hits = sweep(coords, targets, walls, angles, powers, args.steps, args.substeps, args.workers, args.chunk_size)
+    elapsed = perf_counter() - start
+    save(args.out, angles, powers, targets, hits)
+
+    shots = len(angles) * len(powers)
+    print("shots:", shots, "workers:", args.workers, "seconds: %.2f" % elapsed, "shots/s: %.0f" % (shots / elapsed))
+    for j, target in enumerate(targets):
+        print("target %d at %s: hit probability %.4f" % (j, target.coord, hits[j].mean()))
+
+
+if __name__ == "__main__":
+    main()
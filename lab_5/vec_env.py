@@ -0,0 +1,365 @@
+"""
+Runs many copies of the gun game at once for training aiming bots.
+
+VecGunEnv keeps the state of n independent games in stacked arrays and advances all of them with one set of
+vectorized operations per tick, using the physics of gun.py. Every game has the same number of targets and walls
+and room for a fixed number of balls, so nothing is allocated while the games run. Nothing is drawn, so the
+display does not have to be initialized.
+
+ShardedVecEnv splits the games between worker processes, each of which runs a VecGunEnv.
+"""
+import argparse
+import multiprocessing as mp
+from time import perf_counter
+
+import numpy as np
+
+import gun
+
+BALL_RAD = 15
+TARGET_RAD = 30
+WALL_LENGTH = 100
+WALL_WIDTH = 25
+OFF_SCREEN = (-1000, -1000)
+
+
+class VecGunEnv:
+    """
+    n_envs copies of the game. An action of a game is (angle, power, fire): the gun turns to angle, and if fire is
+    true, it shoots a ball with the given power. An episode is one level: it ends when all the targets have been hit
+    and all the balls have stopped, or when max_steps steps have been made. Finished games are reset at once.
+    """
+    def __init__(self, n_envs, seed=None, n_targets=3, n_walls=5, max_balls=8, max_steps=600, substeps=1,
+                 frame_skip=1, ball_collisions=True):
+        """
+        Creates the games and generates their first levels.
+
+        :param n_envs: number of games.
+        :param seed: seed (or numpy SeedSequence) of the random number generator of the levels.
+        :param n_targets: number of targets in a level.
+        :param n_walls: number of walls in a level.
+        :param max_balls: number of balls a game can have at once. The gun does not shoot if they are all flying.
+        :param max_steps: number of steps after which an episode is cut off.
+        :param substeps: number of physics sub-steps in one tick, as in Manager.
+        :param frame_skip: number of physics ticks in one step.
+        :param ball_collisions: if True, balls of a game bounce off each other.
+        """
+        self.n_envs = n_envs
+        self.n_targets = n_targets
+        self.n_walls = n_walls
+        self.max_balls = max_balls
+        self.max_steps = max_steps
+        self.substeps = substeps
+        self.frame_skip = frame_skip
+        self.ball_collisions = ball_collisions
+        self.rng = np.random.default_rng(seed)
+        # Seeds are not repeated, so there is nothing to cache.
+        self.levels = gun.LevelGenerator(max_levels=0, wall_length=WALL_LENGTH, wall_width=WALL_WIDTH,
+                                         ball_rad=BALL_RAD)
+
+        template = gun.Gun()
+        self.gun_coords = template.coords.astype(float)
+        self.min_pow = template.min_pow
+        self.max_pow = template.max_pow
+        self.angle = np.zeros(n_envs)
+        self.power = np.full(n_envs, float(self.min_pow))
+
+        self.balls = gun.BallArray(capacity=n_envs * max_balls)
+        self.balls.add_many(self.gun_coords, np.zeros((n_envs * max_balls, 2)), rad=BALL_RAD)
+        self.balls.alive[:] = False
+        self.coords = self.balls.coords.reshape(n_envs, max_balls, 2)
+        self.vel = self.balls.vel.reshape(n_envs, max_balls, 2)
+        self.alive = self.balls.alive.reshape(n_envs, max_balls)
+        pair = np.triu_indices(max_balls, 1)
+        offset = (np.arange(n_envs) * max_balls)[:, None]
+        self.pair_a = (offset + pair[0]).ravel()
+        self.pair_b = (offset + pair[1]).ravel()
+
+        self.target_coords = np.zeros((n_envs, n_targets, 2))
+        self.target_rad = np.full((n_envs, n_targets), float(TARGET_RAD))
+        self.target_alive = np.zeros((n_envs, n_targets), dtype=bool)
+
+        self.wall_coords = np.zeros((n_envs, n_walls, 2))
+        self.wall_angle = np.zeros((n_envs, n_walls))
+        self.rects = (np.zeros((n_envs * n_walls, 2)), np.zeros((n_envs * n_walls, 2)),
+                      np.zeros((n_envs * n_walls, 2)), np.full(n_envs * n_walls, WALL_WIDTH / 2),
+                      np.full(n_envs * n_walls, WALL_LENGTH / 2))
+
+        self.targets_hit = np.zeros(n_envs, dtype=int)
+        self.balls_used = np.zeros(n_envs, dtype=int)
+        self.steps = np.zeros(n_envs, dtype=int)
+        self.reset()
+
+    @property
+    def observation_size(self):
+        return 2 + 4 * self.n_targets + 3 * self.n_walls + 5 * self.max_balls
+
+    @property
+    def score(self):
+        """
+        Scores of the games, counted the way ScoreTable counts them.
+        """
+        return np.maximum(0, self.targets_hit - self.balls_used)
+
+    def reset(self, mask=None):
+        """
+        Starts new episodes in the games selected by the boolean mask (all the games by default): generates new
+        levels with LevelGenerator, as Manager does, and clears the balls and the score. Returns the observations of
+        all the games.
+        """
+        if mask is None:
+            mask = np.ones(self.n_envs, dtype=bool)
+        idx = np.flatnonzero(mask)
+        k = len(idx)
+        if k:
+            for i, seed in zip(idx, self.rng.integers(2 ** 63, size=k).tolist()):
+                targets, walls = self.levels.layout(seed, self.n_targets, self.n_walls, TARGET_RAD)
+                self.target_coords[i] = [coord for coord, color in targets]
+                # Walls for which the level has no room are parked off the screen, which the balls never leave.
+                self.wall_coords[i] = OFF_SCREEN
+                self.wall_angle[i] = 0
+                for j, (coord, angle) in enumerate(walls):
+                    self.wall_coords[i, j] = coord
+                    self.wall_angle[i, j] = angle
+            self.target_alive[idx] = True
+            self._update_walls(idx)
+
+            self.alive[idx] = False
+            self.coords[idx] = self.gun_coords
+            self.vel[idx] = 0
+            self.angle[idx] = 0
+            self.power[idx] = self.min_pow
+            self.targets_hit[idx] = 0
+            self.balls_used[idx] = 0
+            self.steps[idx] = 0
+        return self.observe()
+
+    def _update_walls(self, idx):
+        """
+        Recomputes the rectangles of the walls of the games idx, the same way Wall does.
+        """
+        angle = self.wall_angle[idx]
+        rows = (idx[:, None] * self.n_walls + np.arange(self.n_walls)).ravel()
+        centres, normals, parallels = self.rects[:3]
+        centres[rows] = self.wall_coords[idx].reshape(-1, 2)
+        normals[rows] = np.stack([np.cos(angle), -np.sin(angle)], axis=-1).reshape(-1, 2)
+        parallels[rows] = np.stack([np.sin(angle), np.cos(angle)], axis=-1).reshape(-1, 2)
+
+    def observe(self):
+        """
+        Returns an (n_envs, observation_size) float32 array. A row is the angle and the power of the gun, then
+        (x, y, radius, alive) of every target, (x, y, angle) of every wall and (x, y, vx, vy, alive) of every ball.
+        """
+        n = self.n_envs
+        return np.concatenate([
+            self.angle[:, None], self.power[:, None],
+            np.concatenate([self.target_coords, self.target_rad[..., None],
+                            self.target_alive[..., None]], axis=-1).reshape(n, -1),
+            np.concatenate([self.wall_coords, self.wall_angle[..., None]], axis=-1).reshape(n, -1),
+            np.concatenate([self.coords, self.vel, self.alive[..., None]], axis=-1).reshape(n, -1),
+        ], axis=1).astype(np.float32)
+
+    def shoot(self, fire):
+        """
+        Shoots a ball from every game selected by the boolean mask fire, which has a free ball slot, the same way
+        Gun.shoot does.
+        """
+        free = ~self.alive
+        envs = np.flatnonzero(fire & free.any(axis=1))
+        slots = free[envs].argmax(axis=1)
+        power = self.power[envs]
+        angle = self.angle[envs]
+        self.coords[envs, slots] = self.gun_coords
+        self.vel[envs, slots, 0] = np.trunc(power * np.cos(angle))
+        self.vel[envs, slots, 1] = np.trunc(power * np.sin(angle))
+        self.alive[envs, slots] = True
+        self.balls_used[envs] += 1
+
+    def step(self, angle, power, fire):
+        """
+        Makes one step in every game.
+
+        :param angle: angles of the guns, an array of n_envs numbers (or one number for all the games).
+        :param power: powers of the shots. They are clipped to the range of powers of Gun.
+        :param fire: boolean flags of the games, whose guns shoot.
+        :return: (observations, rewards, dones). A reward is the change of the score of the game during the step.
+         The observations of the finished games are the first observations of their new episodes.
+        """
+        n = self.n_envs
+        self.angle[:] = np.broadcast_to(angle, n)
+        self.power[:] = np.clip(np.broadcast_to(power, n), self.min_pow, self.max_pow)
+        score = self.score
+        self.shoot(np.broadcast_to(np.asarray(fire, dtype=bool), n))
+        for i in range(self.frame_skip):
+            self.tick()
+        self.steps += 1
+        reward = self.score - score
+        cleared = ~self.target_alive.any(axis=1) & ~self.alive.any(axis=1)
+        done = cleared | (self.steps >= self.max_steps)
+        return self.reset(done), reward, done
+
+    def tick(self):
+        """
+        Advances all the games by one physics tick, doing what Manager.tick does.
+        """
+        t_step = gun.TIME_STEP / self.substeps
+        for i in range(self.substeps):
+            self.check_collisions()
+            self.move(t_step)
+            if self.ball_collisions:
+                alive = self.balls.alive
+                both = alive[self.pair_a] & alive[self.pair_b]
+                gun.collide_balls(self.balls, self.pair_a[both], self.pair_b[both])
+
+    def check_collisions(self):
+        """
+        Checks which balls have hit the targets of their games. Every ball hitting a target counts.
+        """
+        delta = self.coords[:, :, None, :] - self.target_coords[:, None, :, :]
+        hit = np.hypot(delta[..., 0], delta[..., 1]) <= self.target_rad[:, None, :] + BALL_RAD
+        hit &= self.alive[:, :, None] & self.target_alive[:, None, :]
+        self.targets_hit += np.count_nonzero(hit, axis=(1, 2))
+        self.target_alive &= ~hit.any(axis=1)
+
+    def move(self, t_step, g=1.):
+        """
+        Moves the flying balls of all the games the way BallArray.move does. A ball is checked against the walls of
+        its own game only.
+        """
+        balls = self.balls
+        alive = balls.alive
+        vel = balls.vel
+        coords = balls.coords
+        vel[:, 1] += g * t_step * alive
+        live = np.flatnonzero(alive)
+        pair_ball = np.repeat(live, self.n_walls)
+        pair_wall = ((live // self.max_balls * self.n_walls)[:, None] + np.arange(self.n_walls)).ravel()
+        gun.sweep_pairs(coords, vel, balls.rad, vel * t_step * alive[:, None], pair_ball, pair_wall, self.rects)
+        balls.check_walls()
+        stopped = (np.hypot(vel[:, 0], vel[:, 1]) < 1) & (coords[:, 1] > gun.SCREEN_SIZE[1] - 2 * balls.rad)
+        alive &= ~stopped
+
+
+def _worker(conn, n_envs, seed, kwargs):
+    env = VecGunEnv(n_envs, seed=seed, **kwargs)
+    while True:
+        command, args = conn.recv()
+        if command == "step":
+            conn.send(env.step(*args))
+        elif command == "reset":
+            conn.send(env.reset())
+        else:
+            break
+    conn.close()
+
+
+class ShardedVecEnv:
+    """
+    VecGunEnv split between worker processes. Every worker keeps its share of the games and steps it in parallel
+    with the others; the results are joined in the order of the games.
+    """
+    def __init__(self, n_envs, workers=None, seed=None, **kwargs):
+        """
+        Starts the workers.
+
+        :param n_envs: total number of games.
+        :param workers: number of worker processes, the number of CPUs by default.
+        :param seed: seed of the levels. Every worker gets an independent stream spawned from it.
+        :param kwargs: other arguments of VecGunEnv.
+        """
+        if workers is None:
+            workers = mp.cpu_count()
+        workers = max(1, min(workers, n_envs))
+        self.n_envs = n_envs
+        self.sizes = [len(part) for part in np.array_split(np.arange(n_envs), workers)]
+        self.bounds = np.cumsum([0] + self.sizes)
+        seeds = np.random.SeedSequence(seed).spawn(workers)
+        self.conns = []
+        self.processes = []
+        for size, child_seed in zip(self.sizes, seeds):
+            conn, child = mp.Pipe()
+            process = mp.Process(target=_worker, args=(child, size, child_seed, kwargs), daemon=True)
+            process.start()
+            child.close()
+            self.conns.append(conn)
+            self.processes.append(process)
+
+    def reset(self):
+        """
+        Starts new episodes in all the games. Returns their observations.
+        """
+        for conn in self.conns:
+            conn.send(("reset", ()))
+        return np.concatenate([conn.recv() for conn in self.conns])
+
+    def step(self, angle, power, fire):
+        """
+        Does what VecGunEnv.step does, with the games of every worker stepped in parallel.
+        """
+        n = self.n_envs
+        angle = np.broadcast_to(angle, n)
+        power = np.broadcast_to(power, n)
+        fire = np.broadcast_to(fire, n)
+        for i, conn in enumerate(self.conns):
+            part = slice(self.bounds[i], self.bounds[i + 1])
+            conn.send(("step", (angle[part], power[part], fire[part])))
+        results = [conn.recv() for conn in self.conns]
+        return tuple(np.concatenate(arrays) for arrays in zip(*results))
+
+    def close(self):
+        """
+        Stops the workers.
+        """
+        for conn in self.conns:
+            conn.send(("close", ()))
+            conn.close()
+        for process in self.processes:
+            process.join()
+        self.conns = []
+        self.processes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def random_actions(rng, n, fire_prob=0.05):
+    """
+    Returns n random (angle, power, fire) actions.
+    """
+    return rng.uniform(-np.pi / 2, np.pi / 4, n), rng.uniform(10, 40, n), rng.random(n) < fire_prob
+
+
+def measure(env, steps, seed=0):
+    """
+    Steps env with random actions. Returns the number of game steps per second.
+    """
+    rng = np.random.default_rng(seed)
+    env.reset()
+    start = perf_counter()
+    for i in range(steps):
+        env.step(*random_actions(rng, env.n_envs))
+    return steps * env.n_envs / (perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the throughput of the vectorized gun game.")
+    parser.add_argument("--envs", type=int, nargs="+", default=[1, 16, 256, 4096], help="batch sizes")
+    parser.add_argument("--steps", type=int, default=200, help="steps per batch size")
+    parser.add_argument("--workers", type=int, default=0, help="worker processes, 0 to run in this process")
+    args = parser.parse_args()
+
+    print("{:>8} {:>14} {:>14}".format("envs", "steps/s", "per env us"))
+    for n in args.envs:
+        if args.workers:
+            with ShardedVecEnv(n, workers=args.workers, seed=0) as env:
+                rate = measure(env, args.steps)
+        else:
+            rate = measure(VecGunEnv(n, seed=0), args.steps)
+        print("{:>8} {:>14.0f} {:>14.2f}".format(n, rate, 1e6 / rate))
+
+
+if __name__ == "__main__":
+    main()